@@ -0,0 +1,118 @@
+import astropy.io.fits as pyfits
+import astropy.wcs as pywcs
+import os
+import glob
+import numpy as np
+
+
+_BANDS = ['FUV', 'NUV', 'W1', 'W2', 'W3', 'W4', 'MIPS24', 'MIPS70', 'MIPS160']
+
+# OUTPUT-TO-INPUT PIXEL MAPPINGS, KEYED BY (INPUT GRID, REFERENCE GRID).
+# THE GRIDS BELONG TO ONE GALAXY, SO align_galaxy EMPTIES THIS WHEN IT IS DONE.
+_MAP_CACHE = {}
+
+_GRID_KEYS = ['NAXIS1', 'NAXIS2', 'CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2',
+              'CDELT1', 'CDELT2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', 'CROTA2']
+
+
+def grid_key(hdr):
+    # EVERYTHING THAT DEFINES A PIXEL GRID ON THE SKY
+    key = []
+    for k in _GRID_KEYS:
+        val = hdr.get(k)
+        if isinstance(val, float):
+            val = float('%.10g' % val)
+        key.append(val)
+    return tuple(key)
+
+
+def pixel_mapping(in_hdr, ref_hdr):
+    # INPUT PIXEL COORDINATES OF EVERY REFERENCE PIXEL. COMPUTED ONCE PER
+    # PAIR OF GRIDS AND REUSED BY EVERY BAND THAT SHARES THE INPUT GRID.
+    key = (grid_key(in_hdr), grid_key(ref_hdr))
+    if key not in _MAP_CACHE:
+        ny, nx = int(ref_hdr['NAXIS2']), int(ref_hdr['NAXIS1'])
+        yy, xx = np.mgrid[0:ny, 0:nx]
+        ra, dec = pywcs.WCS(ref_hdr, naxis=2).all_pix2world(xx.ravel(), yy.ravel(), 0)
+        x, y = pywcs.WCS(in_hdr, naxis=2).all_world2pix(ra, dec, 0)
+        _MAP_CACHE[key] = np.array([y.reshape(ny, nx), x.reshape(ny, nx)], dtype=np.float32)
+    return _MAP_CACHE[key]
+
+
+def read_image(infile):
+    # DATA AND HEADER OF THE FIRST HDU THAT HOLDS AN IMAGE: THE PRIMARY HDU
+    # FOR fits AND packed PRODUCTS, THE FIRST EXTENSION FOR compressed ONES
+    with pyfits.open(infile) as hdulist:
+        for hdu in hdulist:
+            if hdu.data is not None:
+                return np.array(hdu.data), hdu.header.copy()
+    raise IOError('No image data in ' + infile)
+
+
+def regrid(data, mapping, order=1):
+    # INTERPOLATE SURFACE BRIGHTNESS ONTO THE REFERENCE GRID
+    from scipy.ndimage import map_coordinates
+    return map_coordinates(np.asarray(data, dtype=float), mapping, order=order, mode='constant', cval=np.nan)
+
+
+def mips_files(mips_dir, name):
+    # SINGS MIPS MAPS ARE NAMED BY GALAXY AND WAVELENGTH, E.G. ngc0628_mips24.fits
+    files = {}
+    gal = name.replace('_', '').lower()
+    for f in glob.glob(os.path.join(mips_dir, '*.fits')):
+        base = os.path.basename(f).lower().replace('_', '')
+        if not base.startswith(gal):
+            continue
+        for wave in ['160', '70', '24']:
+            if ('mips' + wave) in base or base.startswith(gal + wave):
+                files.setdefault('MIPS' + wave, f)
+                break
+    return files
+
+
+def band_files(in_dir, name, mips_dir=None):
+    # ALL AVAILABLE CUTOUTS FOR ONE GALAXY, IN BAND ORDER
+    files = {}
+    for band in _BANDS:
+        candidates = glob.glob(os.path.join(in_dir, '_'.join([name, band]).upper() + '*.FITS'))
+        candidates = [f for f in candidates if not (f.endswith('_weight.FITS') or f.endswith('_count.FITS'))]
+        if len(candidates) > 0:
+            files[band] = sorted(candidates)[0]
+    if mips_dir is not None and os.path.exists(mips_dir):
+        for band, f in mips_files(mips_dir, name).items():
+            files.setdefault(band, f)
+    return [(band, files[band]) for band in _BANDS if band in files]
+
+
+def align_galaxy(name, files, out_dir, ref_band=None):
+    # REGRID EVERY BAND ONTO THE REFERENCE BAND'S HEADER AND WRITE ONE CUBE
+    if len(files) == 0:
+        return None
+    bands = [f[0] for f in files]
+    if ref_band not in bands:
+        ref_band = bands[0]
+    ref_data, ref_hdr = read_image(dict(files)[ref_band])
+    ny, nx = int(ref_hdr['NAXIS2']), int(ref_hdr['NAXIS1'])
+
+    cube = np.zeros((len(files), ny, nx))
+    try:
+        for i, (band, infile) in enumerate(files):
+            if band == ref_band:
+                cube[i] = np.squeeze(ref_data)
+            else:
+                data, hdr = read_image(infile)
+                cube[i] = regrid(np.squeeze(data), pixel_mapping(hdr, ref_hdr))
+    finally:
+        _MAP_CACHE.clear()
+
+    hdr = pywcs.WCS(ref_hdr, naxis=2).to_header()
+    hdr['BUNIT'] = ref_hdr.get('BUNIT', 'MJY/SR')
+    hdr['REFBAND'] = ref_band
+    for i, band in enumerate(bands):
+        hdr['BAND' + str(i+1)] = band
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    outfile = os.path.join(out_dir, name.upper() + '_aligned.FITS')
+    pyfits.writeto(outfile, cube, hdr, overwrite=True)
+    return outfile
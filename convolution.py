@@ -0,0 +1,147 @@
+import astropy.io.fits as pyfits
+import os
+import glob
+import collections
+import numpy as np
+
+
+# NAMES OF THE NATIVE PSFS IN THE ANIANO ET AL. (2011) KERNEL FILES
+_KERNEL_PSFS = {'FUV': 'GALEX_FUV',
+                'NUV': 'GALEX_NUV',
+                'W1': 'WISE_FRAME_3.4',
+                'W2': 'WISE_FRAME_4.6',
+                'W3': 'WISE_FRAME_11.6',
+                'W4': 'WISE_FRAME_22.1',
+                'MIPS24': 'MIPS_24',
+                'MIPS70': 'MIPS_70',
+                'MIPS160': 'MIPS_160'}
+
+# REGRIDDED KERNELS, KEYED BY (KERNEL FILE, PIXEL SCALE)
+_KERNEL_CACHE = {}
+
+# PADDED KERNEL FFTS AND THE KERNEL WEIGHT THAT LANDS INSIDE AN IMAGE OF
+# THAT SHAPE, KEYED BY (KERNEL FILE, PIXEL SCALE, IMAGE SHAPE). EVERY
+# ADAPTIVE CUTOUT HAS ITS OWN SHAPE, SO ONLY THE MOST RECENT FEW ARE KEPT.
+_KERNEL_FFT_CACHE = collections.OrderedDict()
+_KERNEL_FFT_CACHE_SIZE = 4
+
+
+def kernel_file(kernel_dir, band, target='Gauss_15'):
+    psf = _KERNEL_PSFS[band.upper()]
+    return os.path.join(kernel_dir, 'Kernel_LoRes_' + psf + '_to_' + target + '.fits')
+
+
+def pixel_scale(hdr):
+    # PIXEL SIZE IN DEGREES FROM EITHER CDELT OR CD KEYWORDS
+    if 'CD1_1' in hdr:
+        return np.sqrt(np.abs(hdr['CD1_1'] * hdr['CD2_2'] - hdr.get('CD1_2', 0.) * hdr.get('CD2_1', 0.)))
+    return np.sqrt(np.abs(hdr['CDELT1'] * hdr['CDELT2']))
+
+
+def overlap_matrix(nin, nout, ratio):
+    # LENGTH OF INPUT PIXEL I INSIDE OUTPUT PIXEL J, BOTH CENTERED ON THE SAME
+    # POINT, WITH OUTPUT PIXELS RATIO INPUT PIXELS WIDE
+    cin, cout = (nin - 1) / 2., (nout - 1) / 2.
+    centers = (np.arange(nout) - cout) * ratio + cin
+    lo = np.maximum((centers - ratio / 2.)[:, None], np.arange(nin)[None, :] - 0.5)
+    hi = np.minimum((centers + ratio / 2.)[:, None], np.arange(nin)[None, :] + 0.5)
+    return np.clip(hi - lo, 0., None)
+
+
+def regrid_kernel(kernel, kernel_scale, pix_scale):
+    # RESAMPLE A CENTERED KERNEL ONTO A NEW PIXEL SCALE BY INTEGRATING IT OVER
+    # THE AREA OF EACH NEW PIXEL, SO NARROW KERNELS KEEP THEIR FLUX WHEN
+    # BINNED DOWN. THE OUTPUT HAS AN ODD NUMBER OF PIXELS WITH THE PEAK ON
+    # THE CENTRAL ONE AND SUMS TO UNITY.
+    ratio = pix_scale / kernel_scale
+    nin = kernel.shape[0]
+    nout = int(np.floor((nin - 1) / ratio)) | 1
+
+    wy = overlap_matrix(kernel.shape[0], nout, ratio)
+    wx = overlap_matrix(kernel.shape[1], nout, ratio)
+    newkernel = np.dot(np.dot(wy, kernel), wx.T)
+
+    return newkernel / np.sum(newkernel)
+
+
+def get_kernel(kfile, pix_scale):
+    # THE KERNEL REGRIDDED TO PIX_SCALE, COMPUTED ONLY ONCE
+    key = (kfile, np.around(pix_scale * 3600., 6))
+    if key not in _KERNEL_CACHE:
+        kernel, khdr = pyfits.getdata(kfile, header=True)
+        _KERNEL_CACHE[key] = regrid_kernel(np.asarray(kernel, dtype=float), pixel_scale(khdr), pix_scale)
+    return _KERNEL_CACHE[key]
+
+
+def get_kernel_fft(kfile, pix_scale, shape):
+    # THE PADDED KERNEL FFT AND EDGE NORMALIZATION FOR AN IMAGE SHAPE
+    key = (kfile, np.around(pix_scale * 3600., 6), tuple(shape))
+    if key in _KERNEL_FFT_CACHE:
+        result = _KERNEL_FFT_CACHE.pop(key)
+    else:
+        from scipy.fftpack import next_fast_len
+        kernel = get_kernel(kfile, pix_scale)
+        fft_shape = tuple(next_fast_len(n + k - 1) for n, k in zip(shape, kernel.shape))
+        kernel_fft = np.fft.rfft2(kernel, fft_shape)
+        edge_norm = kernel_sum(np.ones(shape), kernel_fft, kernel.shape, fft_shape)
+        result = (kernel_fft, kernel.shape, fft_shape, edge_norm)
+    _KERNEL_FFT_CACHE[key] = result
+    while len(_KERNEL_FFT_CACHE) > _KERNEL_FFT_CACHE_SIZE:
+        _KERNEL_FFT_CACHE.popitem(last=False)
+    return result
+
+
+def kernel_sum(data, kernel_fft, kshape, fft_shape):
+    # LINEAR (ZERO PADDED) CONVOLUTION, CROPPED BACK TO THE SHAPE OF DATA
+    ny, nx = data.shape
+    y0, x0 = (kshape[0] - 1) // 2, (kshape[1] - 1) // 2
+    conv = np.fft.irfft2(np.fft.rfft2(data, fft_shape) * kernel_fft, fft_shape)
+    return conv[y0:y0+ny, x0:x0+nx]
+
+
+def fft_convolve(data, kfile, pix_scale):
+    # CONVOLVE WITH THE REGRIDDED KERNEL. BLANK PIXELS AND PIXELS BEYOND THE
+    # IMAGE EDGE ARE LEFT OUT OF THE SUM AND EACH OUTPUT PIXEL IS RENORMALIZED
+    # BY THE KERNEL WEIGHT THAT LANDED ON FINITE DATA, SO EDGES ARE TREATED
+    # THE SAME WITH OR WITHOUT BLANKS. THE ORIGINAL BLANKING IS RESTORED.
+    kernel_fft, kshape, fft_shape, edge_norm = get_kernel_fft(kfile, pix_scale, data.shape)
+
+    good = np.isfinite(data)
+    conv = kernel_sum(np.where(good, data, 0.), kernel_fft, kshape, fft_shape)
+
+    if np.all(good):
+        norm = edge_norm
+    else:
+        norm = kernel_sum(good.astype(float), kernel_fft, kshape, fft_shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        conv = conv / norm
+    conv[~good] = np.nan
+
+    return conv
+
+
+def convolve_cutouts(in_dir, out_dir, kernel_dir, target='Gauss_15'):
+    # CONVOLVE EVERY FINISHED CUTOUT (NAME_BAND.FITS) TO A COMMON PSF
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    infiles = sorted(glob.glob(os.path.join(in_dir, '*.FITS')))
+    infiles = [f for f in infiles if not (f.endswith('_weight.FITS') or f.endswith('_count.FITS'))]
+
+    for infile in infiles:
+        outfile = os.path.join(out_dir, os.path.basename(infile).replace('.FITS', '_' + target + '.FITS'))
+        band = os.path.basename(infile).replace('.FITS', '').split('_')[-1]
+        if os.path.exists(outfile) or band.upper() not in _KERNEL_PSFS:
+            continue
+
+        kfile = kernel_file(kernel_dir, band, target=target)
+        if not os.path.exists(kfile):
+            print('No kernel for ' + band + ' to ' + target)
+            continue
+
+        data, hdr = pyfits.getdata(infile, header=True)
+        newdata = fft_convolve(np.asarray(data, dtype=float), kfile, pixel_scale(hdr))
+
+        hdr['KERNEL'] = os.path.basename(kfile)
+        hdr['comment'] = 'Convolved to ' + target + '.'
+        pyfits.writeto(outfile, newdata, hdr)
@@ -0,0 +1,258 @@
+import astropy.io.fits as pyfits
+import os
+import json
+import zlib
+import fcntl
+import collections
+import numpy as np
+
+
+# A STORE FOR THE WHOLE CUTOUT CATALOG IN A FIXED NUMBER OF SHARDS, HOWEVER
+# MANY GALAXIES IT HOLDS:
+#
+#   root/STORE.json       NUMBER OF SHARDS AND CHUNK SIZE
+#   root/shard-NN.dat     APPEND-ONLY RAW BYTES OF FIXED-SIZE CHUNKS
+#   root/shard-NN.idx     APPEND-ONLY INDEX, ONE JSON LINE PER GALAXY/BAND:
+#                         WCS HEADER, GAL_DATA ROW, AND FOR EACH DATASET
+#                         (image, weight, count) ITS SHAPE, DTYPE AND THE
+#                         OFFSET AND LENGTH OF EVERY CHUNK IN THE .dat
+#
+# A GALAXY ALWAYS LIVES IN THE SAME SHARD (BY A HASH OF ITS NAME). WRITING A
+# BAND APPENDS ITS CHUNKS AND THEN ITS INDEX LINE UNDER AN EXCLUSIVE LOCK ON
+# THE SHARD, SO PARALLEL WORKERS CAN ADD GALAXIES AND BANDS WITHOUT EVER
+# REWRITING WHAT IS THERE, AND READERS ONLY SEE BANDS WHOSE CHUNKS ARE
+# COMPLETE. THE LAST INDEX LINE FOR A GALAXY/BAND WINS; THE BYTES OF A
+# REPLACED BAND STAY IN THE .dat UNREFERENCED. READING A REGION ONLY READS
+# THE CHUNKS THAT TOUCH IT.
+
+_NSHARDS = 64
+_CHUNK = 512
+_DATASETS = ['image', 'weight', 'count']
+
+# PARSED SHARD INDICES, KEYED BY (PATH, SIZE). ONLY THE LAST FEW ARE KEPT.
+_INDEX_CACHE = collections.OrderedDict()
+_INDEX_CACHE_SIZE = 4
+
+
+def _scalar(val):
+    if isinstance(val, bytes):
+        return val.decode('ascii', 'replace').strip()
+    if isinstance(val, np.generic):
+        val = val.item()
+    if isinstance(val, str):
+        return val.strip()
+    return val
+
+
+def row_to_dict(row):
+    # A GAL_DATA RECORD (FITS_record OR NUMPY RECORD) AS PLAIN PYTHON VALUES
+    if hasattr(row, 'array'):
+        names = row.array.names
+    else:
+        names = row.dtype.names
+    return dict((name.lower(), _scalar(row[name])) for name in names)
+
+
+def store_config(root, nshards=_NSHARDS, chunk=_CHUNK):
+    # THE LAYOUT OF AN EXISTING STORE, OR A NEW ONE CREATED WITH THESE VALUES
+    config_file = os.path.join(root, 'STORE.json')
+    if not os.path.exists(config_file):
+        if not os.path.exists(root):
+            try:
+                os.makedirs(root)
+            except OSError:
+                pass
+        tmp = config_file + '.tmp' + str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'nshards': nshards, 'chunk': chunk}, f)
+        if not os.path.exists(config_file):
+            os.rename(tmp, config_file)
+        else:
+            os.remove(tmp)
+    with open(config_file) as f:
+        return json.load(f)
+
+
+def shard_of(root, name):
+    nshards = store_config(root)['nshards']
+    return (zlib.crc32(name.upper().encode('ascii')) & 0xffffffff) % nshards
+
+
+def shard_files(root, shard):
+    base = os.path.join(root, 'shard-%02d' % shard)
+    return base + '.dat', base + '.idx'
+
+
+def write_galaxy(root, name, groups):
+    # APPEND BANDS OF ONE GALAXY. GROUPS MAPS BAND TO (ARRAYS, HEADER, ATTRS),
+    # WHERE ARRAYS MAPS DATASET NAME TO A 2D ARRAY. OTHER BANDS ALREADY
+    # STORED FOR THIS GALAXY ARE LEFT AS THEY ARE.
+    config = store_config(root)
+    chunk = config['chunk']
+    dat_file, idx_file = shard_files(root, shard_of(root, name))
+
+    with open(idx_file, 'a') as idx:
+        fcntl.flock(idx, fcntl.LOCK_EX)
+        try:
+            with open(dat_file, 'ab') as dat:
+                dat.seek(0, 2)
+                lines = []
+                for band, (arrays, header, attrs) in groups.items():
+                    record = {'name': name.upper(), 'band': band.upper(), 'header': header.tostring(),
+                              'chunk': chunk, 'attrs': attrs or {}, 'datasets': {}}
+                    for dname, data in arrays.items():
+                        data = np.asarray(data)
+                        ny, nx = data.shape
+                        chunks = {}
+                        for iy in range(0, ny, chunk):
+                            for ix in range(0, nx, chunk):
+                                buf = np.ascontiguousarray(data[iy:iy+chunk, ix:ix+chunk]).tobytes()
+                                chunks['%d.%d' % (iy // chunk, ix // chunk)] = [dat.tell(), len(buf)]
+                                dat.write(buf)
+                        record['datasets'][dname] = {'shape': [ny, nx], 'dtype': data.dtype.str, 'chunks': chunks}
+                    lines.append(json.dumps(record) + '\n')
+                dat.flush()
+                os.fsync(dat.fileno())
+            idx.write(''.join(lines))
+            idx.flush()
+            os.fsync(idx.fileno())
+        finally:
+            fcntl.flock(idx, fcntl.LOCK_UN)
+    return dat_file
+
+
+def write_group(root, name, band, arrays, header, attrs=None):
+    # WRITE (OR REPLACE) ONE GALAXY/BAND GROUP
+    return write_galaxy(root, name, {band: (arrays, header, attrs)})
+
+
+def read_index(root, shard):
+    # LATEST RECORD OF EVERY GALAXY/BAND IN ONE SHARD. A LINE STILL BEING
+    # WRITTEN IS SKIPPED.
+    dat_file, idx_file = shard_files(root, shard)
+    if not os.path.exists(idx_file):
+        return {}
+    key = (os.path.realpath(idx_file), os.path.getsize(idx_file))
+    if key in _INDEX_CACHE:
+        index = _INDEX_CACHE.pop(key)
+    else:
+        index = {}
+        with open(idx_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                index[(record['name'], record['band'])] = record
+    _INDEX_CACHE[key] = index
+    while len(_INDEX_CACHE) > _INDEX_CACHE_SIZE:
+        _INDEX_CACHE.popitem(last=False)
+    return index
+
+
+def _meta(record):
+    meta = dict(record)
+    meta['header'] = pyfits.Header.fromstring(record['header'])
+    return meta
+
+
+def read_attrs(root, name, band):
+    record = read_index(root, shard_of(root, name))[(name.upper(), band.upper())]
+    return _meta(record)
+
+
+def read_dataset(root, name, band, dataset='image', region=None, meta=None, dat=None):
+    # READ A DATASET, OR ONLY THE CHUNKS THAT TOUCH REGION = (y0, y1, x0, x1)
+    if dat is None:
+        with open(shard_files(root, shard_of(root, name))[0], 'rb') as dat:
+            return read_dataset(root, name, band, dataset, region=region, meta=meta, dat=dat)
+    if meta is None:
+        meta = read_attrs(root, name, band)
+    chunk = meta['chunk']
+    info = meta['datasets'][dataset]
+    dtype = np.dtype(info['dtype'])
+    ny, nx = info['shape']
+    if region is None:
+        region = (0, ny, 0, nx)
+    y0, y1, x0, x1 = region
+
+    out = np.empty((y1 - y0, x1 - x0), dtype=dtype)
+    for iy in range(y0 // chunk, (y1 - 1) // chunk + 1):
+        for ix in range(x0 // chunk, (x1 - 1) // chunk + 1):
+            offset, nbytes = info['chunks']['%d.%d' % (iy, ix)]
+            by0, bx0 = iy * chunk, ix * chunk
+            bny, bnx = min(chunk, ny - by0), min(chunk, nx - bx0)
+            dat.seek(offset)
+            block = np.frombuffer(dat.read(nbytes), dtype=dtype).reshape(bny, bnx)
+            sy0, sy1 = max(y0, by0), min(y1, by0 + bny)
+            sx0, sx1 = max(x0, bx0), min(x1, bx0 + bnx)
+            out[sy0-y0:sy1-y0, sx0-x0:sx1-x0] = block[sy0-by0:sy1-by0, sx0-bx0:sx1-bx0]
+    return out
+
+
+def iter_groups(root):
+    # (NAME, BAND) FOR EVERY GROUP IN THE STORE
+    nshards = store_config(root)['nshards']
+    for shard in range(nshards):
+        for key in sorted(read_index(root, shard)):
+            yield key
+
+
+def scan(root, func, dataset='image', band=None):
+    # APPLY FUNC(NAME, BAND, DATA, META) TO EVERY GROUP IN ONE SEQUENTIAL
+    # PASS, OPENING EACH SHARD ONCE AND READING ITS CHUNKS IN FILE ORDER
+    results = []
+    nshards = store_config(root)['nshards']
+    for shard in range(nshards):
+        index = read_index(root, shard)
+        if len(index) == 0:
+            continue
+        records = [r for r in index.values() if band is None or r['band'] == band.upper()]
+        records = [r for r in records if dataset in r['datasets']]
+        records.sort(key=lambda r: min(c[0] for c in r['datasets'][dataset]['chunks'].values()))
+        with open(shard_files(root, shard)[0], 'rb') as dat:
+            for record in records:
+                meta = _meta(record)
+                data = read_dataset(root, record['name'], record['band'], dataset, meta=meta, dat=dat)
+                results.append(func(record['name'], record['band'], data, meta))
+    return results
+
+
+def read_products(name, band, product_dir):
+    # THE FINISHED PRODUCTS OF ONE GALAXY/BAND AS (ARRAYS, HEADER). HANDLES
+    # BOTH SEPARATE _weight/_count FILES AND PACKED/COMPRESSED EXTENSIONS.
+    prefix = os.path.join(product_dir, '_'.join([name, band]).upper())
+    if not os.path.exists(prefix + '.FITS'):
+        return None
+
+    arrays, header = {}, None
+    with pyfits.open(prefix + '.FITS') as hdulist:
+        for hdu in hdulist:
+            if hdu.data is None:
+                continue
+            dname = 'image' if header is None else hdu.name.lower()
+            if header is None:
+                header = hdu.header.copy()
+            arrays[dname] = np.array(hdu.data)
+    for dname in _DATASETS[1:]:
+        sibling = prefix + '_' + dname + '.FITS'
+        if dname not in arrays and os.path.exists(sibling):
+            arrays[dname] = pyfits.getdata(sibling)
+    return arrays, header
+
+
+def add_galaxy(root, name, bands, product_dir, attrs=None):
+    # COPY THE FINISHED PRODUCTS OF SOME BANDS OF ONE GALAXY INTO THE STORE
+    # WITH A SINGLE APPEND
+    groups = {}
+    for band in bands:
+        products = read_products(name, band, product_dir)
+        if products is not None:
+            groups[band] = (products[0], products[1], attrs)
+    if len(groups) == 0:
+        return None
+    return write_galaxy(root, name, groups)
+
+
+def add_products(root, name, band, product_dir, attrs=None):
+    return add_galaxy(root, name, [band], product_dir, attrs=attrs)
@@ -0,0 +1,232 @@
+import astropy.io.fits as pyfits
+import os
+import gzip
+import shutil
+import threading
+import manifest
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+
+def fits_ok(path):
+    # THE FILE PARSES AS FITS AND IS EXACTLY AS LONG AS ITS HEADERS SAY
+    size = os.path.getsize(path)
+    if size == 0 or size % 2880 != 0:
+        return False
+    try:
+        with pyfits.open(path, memmap=False, lazy_load_hdus=False) as hdulist:
+            info = hdulist.fileinfo(len(hdulist) - 1)
+            return info['datLoc'] + info['datSpan'] == size
+    except Exception:
+        return False
+
+
+def index_layout(index, columns=('fname', 'rrhrfile', 'flagfile')):
+    # PATH OF EVERY TILE RELATIVE TO sorted_tiles, KEYED BY FILE NAME, FROM
+    # THE COLUMNS THAT surveys.mosaic JOINS ONTO THE DATA DIRECTORY
+    layout = {}
+    for col in columns:
+        for f in index[col]:
+            f = str(f).strip()
+            layout[os.path.basename(f)] = f
+    return layout
+
+
+def rebase(url, base_url):
+    # SAME PATH ON ANOTHER SERVER, E.G. A MIRROR OR A LOCAL TEST SERVER
+    if base_url is None:
+        return url
+    parts = urlsplit(url)
+    return base_url.rstrip('/') + parts.path + ('?' + parts.query if parts.query else '')
+
+
+class TileDownloader(object):
+    # FETCH A MANIFEST OF TILES WITH A BOUNDED POOL OF THREADS, EACH KEEPING
+    # ONE PERSISTENT CONNECTION PER HOST. PARTIAL FILES ARE RESUMED WITH RANGE
+    # REQUESTS, EVERY FILE IS CHECKED AGAINST THE SERVER'S SIZE AND AS FITS,
+    # AND ONLY VERIFIED FILES ARE MOVED INTO PLACE UNDER OUT_DIR.
+
+    def __init__(self, out_dir, nthreads=8, base_url=None, layout=None, timeout=60, retries=3, blocksize=1 << 20):
+        self.out_dir = out_dir
+        self.base_url = base_url
+        self.layout = layout or {}
+        self.timeout = timeout
+        self.retries = retries
+        self.blocksize = blocksize
+        self.nthreads = nthreads
+        self._lock = threading.Lock()
+
+    def local_path(self, url):
+        # WHERE surveys.mosaic WILL LOOK FOR THE TILE: THE INDEX LAYOUT IF GIVEN,
+        # OTHERWISE FLAT. GZIPPED TILES ARE STORED UNCOMPRESSED.
+        fname = os.path.basename(urlsplit(url).path)
+        if fname.endswith('.gz'):
+            fname = fname[:-3]
+        return os.path.join(self.out_dir, self.layout.get(fname, fname))
+
+    def download(self, urls):
+        # FETCH EVERY URL; RETURNS COUNTS OF EACH OUTCOME AND THE FAILED URLS
+        self._counts, self._failed = {}, []
+        work = queue.Queue()
+        for url in urls:
+            work.put(url)
+        threads = []
+        for i in range(min(self.nthreads, max(len(urls), 1))):
+            work.put(None)
+            t = threading.Thread(target=self._work, args=(work,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        return self._counts, self._failed
+
+    def _record(self, url, status):
+        with self._lock:
+            self._counts[status] = self._counts.get(status, 0) + 1
+            if status == 'failed':
+                self._failed.append(url)
+
+    def _work(self, work):
+        conns = {}
+        while True:
+            url = work.get()
+            if url is None:
+                break
+            status = 'failed'
+            for attempt in range(self.retries):
+                try:
+                    status = self._fetch(url, conns)
+                    break
+                except (httplib.HTTPException, IOError, OSError, ValueError):
+                    # DROP THE CONNECTION AND TRY AGAIN, RESUMING FROM THE PART FILE
+                    host = urlsplit(rebase(url, self.base_url)).netloc
+                    if host in conns:
+                        conns.pop(host).close()
+            self._record(url, status)
+        for conn in conns.values():
+            conn.close()
+
+    def _connection(self, conns, parts):
+        if parts.netloc not in conns:
+            if parts.scheme == 'https':
+                conns[parts.netloc] = httplib.HTTPSConnection(parts.netloc, timeout=self.timeout)
+            else:
+                conns[parts.netloc] = httplib.HTTPConnection(parts.netloc, timeout=self.timeout)
+        return conns[parts.netloc]
+
+    def _fetch(self, url, conns):
+        final = self.local_path(url)
+        if os.path.exists(final) and fits_ok(final):
+            return 'skipped'
+        final_dir = os.path.dirname(final)
+        if not os.path.exists(final_dir):
+            try:
+                os.makedirs(final_dir)
+            except OSError:
+                pass
+
+        src = rebase(url, self.base_url)
+        parts = urlsplit(src)
+        part = final + ('.gz' if parts.path.endswith('.gz') else '') + '.part'
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+
+        conn = self._connection(conns, parts)
+        headers = {'Connection': 'keep-alive'}
+        if offset > 0:
+            headers['Range'] = 'bytes=' + str(offset) + '-'
+        conn.request('GET', parts.path + ('?' + parts.query if parts.query else ''), headers=headers)
+        resp = conn.getresponse()
+
+        if resp.status == 416 and offset > 0:
+            # THE PART FILE IS ALREADY COMPLETE
+            resp.read()
+            total = offset
+        elif resp.status in (200, 206):
+            if resp.status == 200:
+                offset = 0
+            total = None
+            if resp.status == 206 and resp.getheader('Content-Range'):
+                total = int(resp.getheader('Content-Range').split('/')[-1])
+            elif resp.getheader('Content-Length'):
+                total = offset + int(resp.getheader('Content-Length'))
+            with open(part, 'ab' if offset > 0 else 'wb') as f:
+                block = resp.read(self.blocksize)
+                while block:
+                    f.write(block)
+                    block = resp.read(self.blocksize)
+        else:
+            resp.read()
+            if resp.status == 404:
+                return 'failed'
+            raise IOError('HTTP ' + str(resp.status) + ' for ' + src)
+
+        if total is not None and os.path.getsize(part) != total:
+            raise IOError('Short read for ' + src)
+        return self._finish(part, final)
+
+    def _finish(self, part, final):
+        # DECOMPRESS IF NEEDED, CHECK THE FITS STRUCTURE AND MOVE INTO PLACE
+        tmp = final + '.tmp'
+        try:
+            if part.endswith('.gz.part'):
+                with gzip.open(part, 'rb') as fin:
+                    with open(tmp, 'wb') as fout:
+                        shutil.copyfileobj(fin, fout, self.blocksize)
+            else:
+                os.rename(part, tmp)
+        except (IOError, OSError, EOFError):
+            # A CORRUPT ARCHIVE CANNOT BE RESUMED; START OVER NEXT TIME
+            for f in [part, tmp]:
+                if os.path.exists(f):
+                    os.remove(f)
+            return 'failed'
+
+        if not fits_ok(tmp):
+            os.remove(tmp)
+            if os.path.exists(part):
+                os.remove(part)
+            return 'failed'
+
+        os.rename(tmp, final)
+        if os.path.exists(part):
+            os.remove(part)
+        return 'downloaded'
+
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser(description='Download the tiles listed in a manifest into a sorted_tiles directory.')
+    parser.add_argument('manifest', help='file of download commands, e.g. from make_cutouts.py --manifest.')
+    parser.add_argument('out_dir', help='sorted_tiles directory to fill.')
+    parser.add_argument('--nthreads', default=8, type=int, help='number of concurrent connections. Default: 8.')
+    parser.add_argument('--base_url', default=None, help='fetch the same paths from this server instead, e.g. http://localhost:8000.')
+    parser.add_argument('--index', default=None, help='telescope index file whose paths define the layout. Default: flat.')
+    return parser.parse_args()
+
+
+def main(**kwargs):
+    layout = None
+    if kwargs['index'] is not None:
+        layout = index_layout(pyfits.getdata(kwargs['index'], 1))
+    urls = manifest.read_manifest(kwargs['manifest'])
+    downloader = TileDownloader(kwargs['out_dir'], nthreads=kwargs['nthreads'], base_url=kwargs['base_url'], layout=layout)
+    counts, failed = downloader.download(urls)
+    print('Downloads: ' + str(counts))
+    for url in failed:
+        print('Failed: ' + url)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(**vars(args))
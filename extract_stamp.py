@@ -1,18 +1,20 @@
 import astropy.io.fits as pyfits
-from astropy.io import ascii
-from astropy.table import Table, Column
 import astropy.wcs as pywcs
 import os
 import numpy as np
-import montage_wrapper as montage
 import shutil
 import sys
 import glob
 import time
-from matplotlib.path import Path
-from scipy.ndimage import zoom
+import warnings
+import collections
+import staging
+import align
 from pdb import set_trace
 
+# MONTAGE AND MATPLOTLIB ARE IMPORTED BY THE STAGES THAT USE THEM, SO
+# PLANNING, DRY RUNS AND WORKERS THAT ONLY NEED THE GEOMETRY START QUICKLY
+
 
 _TOP_DIR = '/data/tycho/0/leroy.42/allsky/'
 _INDEX_DIR = os.path.join(_TOP_DIR, 'code/')
@@ -138,11 +140,16 @@ def make_axes(hdr, quiet=False, novec=False, vonly=False, simple=False):
     return rimg, dimg
 
 
-def write_headerfile(header_file, header):
+def header_template(header):
+    # MONTAGE-STYLE .hdr TEXT: ONE CARD IMAGE PER LINE AND NO END CARD
+    return ''.join(card.image.strip() + '\n' for card in header.cards)
+
+
+def write_headerfile(header_file, header, template=None):
+    if template is None:
+        template = header_template(header)
     f = open(header_file, 'w')
-    for iii in range(len(header)):
-        outline = str(header[iii:iii+1]).strip().rstrip('END').strip()+'\n'
-        f.write(outline)
+    f.write(template)
     f.close()
 
 
@@ -163,41 +170,301 @@ def create_hdr(ra_ctr, dec_ctr, pix_len, pix_scale):
     return hdr
 
 
+# TARGET HEADERS AND THEIR .hdr TEXT, KEYED BY (RA, DEC, PIX_LEN, PIX_SCALE)
+_HDR_CACHE = {}
+
+
+def target_header(ra_ctr, dec_ctr, pix_len, pix_scale, bunit='MJY/SR'):
+    # FULL PRIMARY HEADER FOR A CUTOUT PLUS ITS SERIALIZED TEMPLATE. THE
+    # CALLER GETS A COPY OF THE HEADER SO IT CAN BE MODIFIED FREELY.
+    key = (float(ra_ctr), float(dec_ctr), float(pix_len), float(pix_scale), bunit)
+    if key not in _HDR_CACHE:
+        hdr = create_hdr(ra_ctr, dec_ctr, int(np.around(pix_len)), pix_scale)
+        full = pyfits.Header([('SIMPLE', True), ('BITPIX', -64)])
+        full.extend(hdr, strip=False)
+        full['BUNIT'] = bunit
+        _HDR_CACHE[key] = (full, header_template(full))
+    hdr, template = _HDR_CACHE[key]
+    return hdr.copy(), template
+
+
+def image_footprint(hdr, nsamp=9):
+    # WORLD COORDINATES OF POINTS ALONG THE OUTER PIXEL EDGES OF AN IMAGE
+    naxis1 = int(np.around(hdr['NAXIS1']))
+    naxis2 = int(np.around(hdr['NAXIS2']))
+    ww = pywcs.WCS(hdr, naxis=2)
+
+    # WALK COUNTERCLOCKWISE AROUND THE EDGES: BOTTOM, RIGHT, TOP, LEFT
+    t = np.linspace(0., 1., nsamp)[:-1]
+    lo = np.zeros_like(t)
+    x = 0.5 + naxis1 * np.concatenate([t, lo + 1., 1. - t, lo])
+    y = 0.5 + naxis2 * np.concatenate([lo, t, lo + 1., 1. - t])
+
+    ra, dec = ww.all_pix2world(x, y, 1)
+    return ra, dec
+
+
+def tile_section(tile_hdr, target_hdr, margin=8, align=1):
+    # PIXEL BOUNDING BOX (y0, y1, x0, x1) OF THE TARGET FOOTPRINT ON A TILE,
+    # PADDED BY A REPROJECTION MARGIN. RETURNS NONE IF THEY DO NOT OVERLAP.
+    naxis1, naxis2 = tile_hdr['NAXIS1'], tile_hdr['NAXIS2']
+    ra, dec = image_footprint(target_hdr)
+    ww = pywcs.WCS(tile_hdr, naxis=2)
+    x, y = ww.all_world2pix(ra, dec, 0)
+
+    # POINTS THAT DO NOT PROJECT ONTO THE TILE PLANE: FALL BACK TO THE FULL TILE
+    if not (np.all(np.isfinite(x)) and np.all(np.isfinite(y))):
+        return (0, naxis2, 0, naxis1)
+
+    x0 = max(int(np.floor(x.min())) - margin, 0)
+    x1 = min(int(np.ceil(x.max())) + margin + 1, naxis1)
+    y0 = max(int(np.floor(y.min())) - margin, 0)
+    y1 = min(int(np.ceil(y.max())) + margin + 1, naxis2)
+
+    # SNAP TO A MULTIPLE OF ALIGN SO LOWER RESOLUTION MAPS STAY REGISTERED
+    x0, y0 = x0 - x0 % align, y0 - y0 % align
+    x1 = min(-(-x1 // align) * align, naxis1)
+    y1 = min(-(-y1 // align) * align, naxis2)
+
+    if (x0 >= x1) or (y0 >= y1):
+        return None
+    return (y0, y1, x0, x1)
+
+
+def tangent_plane(ra, dec, ra0, dec0):
+    # GNOMONIC PROJECTION ABOUT (ra0, dec0). COS_C <= 0 MARKS POINTS ON THE FAR HEMISPHERE
+    ra, dec = np.radians(ra), np.radians(dec)
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    cos_c = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    xi = np.cos(dec) * np.sin(ra - ra0) / cos_c
+    eta = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cos_c
+    return xi, eta, cos_c
+
+
+def points_in_polygon(x, y, px, py):
+    # EVEN-ODD RULE, VECTORIZED OVER POINTS AND POLYGON EDGES
+    x, y = np.asarray(x).reshape(-1, 1), np.asarray(y).reshape(-1, 1)
+    qx, qy = np.roll(px, -1), np.roll(py, -1)
+    crosses = (py > y) != (qy > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_int = px + (y - py) * (qx - px) / (qy - py)
+    return np.sum(crosses & (x < x_int), axis=1) % 2 == 1
+
+
+def polygons_intersect(ax, ay, bx, by):
+    # ANY VERTEX INSIDE THE OTHER POLYGON OR ANY PAIR OF CROSSING EDGES
+    if np.any(points_in_polygon(ax, ay, bx, by)) or np.any(points_in_polygon(bx, by, ax, ay)):
+        return True
+    a0x, a0y = ax.reshape(-1, 1), ay.reshape(-1, 1)
+    a1x, a1y = np.roll(ax, -1).reshape(-1, 1), np.roll(ay, -1).reshape(-1, 1)
+    b0x, b0y, b1x, b1y = bx, by, np.roll(bx, -1), np.roll(by, -1)
+
+    def side(p0x, p0y, p1x, p1y, qx, qy):
+        return np.sign((p1x - p0x) * (qy - p0y) - (p1y - p0y) * (qx - p0x))
+
+    d1 = side(a0x, a0y, a1x, a1y, b0x, b0y)
+    d2 = side(a0x, a0y, a1x, a1y, b1x, b1y)
+    d3 = side(b0x, b0y, b1x, b1y, a0x, a0y)
+    d4 = side(b0x, b0y, b1x, b1y, a1x, a1y)
+    return bool(np.any((d1 * d2 < 0) & (d3 * d4 < 0)))
+
+
+def footprints_overlap(hdr, target_hdr):
+    # TEST WHETHER TWO IMAGES TOUCH ON THE SKY USING ONLY THEIR EDGES. BOTH
+    # FOOTPRINTS ARE PROJECTED ONTO THE TANGENT PLANE AT THE TARGET CENTER.
+    ra_t, dec_t = image_footprint(target_hdr)
+    ra_i, dec_i = image_footprint(hdr)
+    ra0, dec0 = target_hdr['CRVAL1'], target_hdr['CRVAL2']
+
+    xi_t, eta_t, cos_t = tangent_plane(ra_t, dec_t, ra0, dec0)
+    xi_i, eta_i, cos_i = tangent_plane(ra_i, dec_i, ra0, dec0)
+
+    # ANY PART OF THE IMAGE ON THE FAR SIDE OF THE SKY CANNOT BE PROJECTED;
+    # NONE OF OUR IMAGES SPAN A HEMISPHERE SO ONLY THE ALL-FAR CASE IS DISJOINT
+    if np.all(cos_i <= 0):
+        return False
+    if np.any(cos_i <= 0):
+        return True
+    return polygons_intersect(xi_t, eta_t, xi_i, eta_i)
+
+
+def section_header(hdr, section):
+    # SHIFT THE WCS OF A HEADER TO DESCRIBE A SUBARRAY. THE OFFSET FROM THE
+    # PARENT TILE IS KEPT IN THE IRAF LTV KEYWORDS (PHYSICAL = LOGICAL - LTV)
+    y0, y1, x0, x1 = section
+    hdr = hdr.copy()
+    hdr['NAXIS1'] = x1 - x0
+    hdr['NAXIS2'] = y1 - y0
+    hdr['CRPIX1'] -= x0
+    hdr['CRPIX2'] -= y0
+    hdr['LTV1'] = hdr.get('LTV1', 0) - x0
+    hdr['LTV2'] = hdr.get('LTV2', 0) - y0
+    return hdr
 
 
-def unwise(band=None, ra_ctr=None, dec_ctr=None, size_deg=None, index=None, name=None):
-    tel = 'unwise'
-    data_dir = os.path.join(_TOP_DIR, tel, 'sorted_tiles')
-
-    # READ THE INDEX FILE (IF NOT PASSED IN)
-    if index is None:
-        indexfile = os.path.join(_INDEX_DIR, tel + '_index_file.fits')
-        ext = 1
-        index, hdr = pyfits.getdata(indexfile, ext, header=True)
-
-    # CALIBRATION TO GO FROM VEGAS TO ABMAG
-    w1_vtoab = 2.683
-    w2_vtoab = 3.319
-    w3_vtoab = 5.242
-    w4_vtoab = 6.604
-
-    # NORMALIZATION OF UNITY IN VEGAS MAG
-    norm_mag = 22.5
-    pix_as = 2.75  #arcseconds - native detector pixel size wise docs
-
-    # COUNTS TO JY CONVERSION
-    w1_to_mjysr = counts2jy(norm_mag, w1_vtoab, pix_as)
-    w2_to_mjysr = counts2jy(norm_mag, w2_vtoab, pix_as)
-    w3_to_mjysr = counts2jy(norm_mag, w3_vtoab, pix_as)
-    w4_to_mjysr = counts2jy(norm_mag, w4_vtoab, pix_as)
-
-    # MAKE A HEADER
-    pix_scale = 2.0 / 3600.  # 2.0 arbitrary
-    pix_len = size_deg / pix_scale
-
-    # this should automatically populate SIMPLE and NAXIS keywords
-    target_hdr = create_hdr(ra_ctr, dec_ctr, pix_len, pix_scale)
-
+def read_section(infile, section=None):
+    # MEMORY-MAP A FITS IMAGE AND READ ONLY THE PIXELS INSIDE SECTION
+    with pyfits.open(infile, memmap=True) as hdulist:
+        hdr = hdulist[0].header.copy()
+        if section is None:
+            return np.array(hdulist[0].data), hdr
+        y0, y1, x0, x1 = section
+        data = np.array(hdulist[0].section[y0:y1, x0:x1])
+    return data, section_header(hdr, section)
+
+
+# MEAN OF EACH WHOLE TILE, KEYED BY (TILE, MTIME, STEP)
+_TILE_MEAN_CACHE = {}
+
+
+def tile_mean(infile, step=8):
+    # MEAN OF THE WHOLE TILE FROM EVERY STEP-TH ROW OF A MEMORY-MAPPED READ.
+    # THE LEVEL REMOVED FROM A TILE MUST NOT DEPEND ON WHICH SECTION OF IT A
+    # CUTOUT HAPPENS TO USE.
+    key = (os.path.realpath(infile), os.path.getmtime(infile), step)
+    if key not in _TILE_MEAN_CACHE:
+        with pyfits.open(infile, memmap=True) as hdulist:
+            _TILE_MEAN_CACHE[key] = float(np.mean(hdulist[0].section[::step, :]))
+    return _TILE_MEAN_CACHE[key]
+
+
+
+
+def unwise(band=1, ra_ctr=None, dec_ctr=None, size_deg=None, index=None, name=None, write_info=True, model_bg=False, prefetcher=None, out_format='fits', float32=False, pyramid=0):
+    # UNWISE MOSAICS COME FROM THE SHARED SURVEY ENGINE (SEE surveys.py)
+    import surveys
+    return surveys.mosaic(surveys.UNWISE, band, ra_ctr, dec_ctr, size_deg, name, index=index, write_info=write_info,
+                          model_bg=model_bg, prefetcher=prefetcher, out_format=out_format, float32=float32, pyramid=pyramid)
+
+
+def product_file(out_dir, prefix, extname):
+    if extname == 'IMAGE':
+        return os.path.join(out_dir, prefix + '.FITS')
+    return os.path.join(out_dir, prefix + '_' + extname.lower() + '.FITS')
+
+
+def write_products(name, band, mosaic_file, weight_file, count_file, out_dir, out_format='fits', float32=False, pyramid_file=None):
+    # WRITE THE FINAL IMAGE, WEIGHT AND COUNT MAPS IN ONE OF THREE LAYOUTS:
+    #   fits       -- NAME_BAND.FITS, NAME_BAND_weight.FITS, NAME_BAND_count.FITS
+    #   packed     -- NAME_BAND.FITS WITH WEIGHT AND COUNT EXTENSIONS
+    #   compressed -- AS PACKED, BUT TILE COMPRESSED: RICE WITH QUANTIZATION
+    #                 FOR THE IMAGE, LOSSLESS GZIP FOR WEIGHT AND COUNT
+    prefix = '_'.join([name, band]).upper()
+    planes = [('IMAGE', mosaic_file), ('WEIGHT', weight_file), ('COUNT', count_file)]
+    planes = [(extname, f) for extname, f in planes if f is not None]
+
+    # THE PYRAMID ALWAYS GOES ALONGSIDE AS NAME_BAND_pyramid.FITS
+    if pyramid_file is not None:
+        staging.stage_file(pyramid_file, product_file(out_dir, prefix, 'PYRAMID'), move=True)
+
+    if out_format == 'fits' and not float32:
+        pairs = [(f, product_file(out_dir, prefix, extname)) for extname, f in planes]
+        staging.stage_products(pairs, move=True)
+        return
+
+    hdus = []
+    for extname, f in planes:
+        data, hdr = pyfits.getdata(f, header=True)
+        if float32:
+            data = data.astype(np.float32)
+        if out_format == 'fits':
+            outfile = product_file(out_dir, prefix, extname)
+            pyfits.writeto(outfile + '.tmp', data, hdr)
+            os.rename(outfile + '.tmp', outfile)
+        elif out_format == 'packed':
+            if extname == 'IMAGE':
+                hdus.append(pyfits.PrimaryHDU(data=data, header=hdr))
+            else:
+                hdus.append(pyfits.ImageHDU(data=data, header=hdr, name=extname))
+        elif out_format == 'compressed':
+            if extname == 'IMAGE':
+                hdus.append(pyfits.PrimaryHDU())
+                hdus.append(pyfits.CompImageHDU(data=data, header=hdr, name=extname, compression_type='RICE_1', quantize_level=16.))
+            else:
+                hdus.append(pyfits.CompImageHDU(data=data, header=hdr, name=extname, compression_type='GZIP_2', quantize_level=0.))
+        else:
+            raise ValueError('Unknown output format: ' + out_format)
+
+    if len(hdus) > 0:
+        outfile = os.path.join(out_dir, prefix + '.FITS')
+        pyfits.HDUList(hdus).writeto(outfile + '.tmp')
+        os.rename(outfile + '.tmp', outfile)
+
+
+def cutout_section(field_hdr, ra_ctr, dec_ctr, pix_len):
+    # PIX_LEN X PIX_LEN BOX OF THE FIELD GRID WITH (RA, DEC) WHERE create_hdr
+    # PUTS THE CENTER. MAY RUN OFF THE EDGE OF THE FIELD.
+    x, y = pywcs.WCS(field_hdr, naxis=2).all_world2pix([ra_ctr], [dec_ctr], 0)
+    x0 = int(np.around(x[0] - (pix_len / 2. - 1)))
+    y0 = int(np.around(y[0] - (pix_len / 2. - 1)))
+    return (y0, y0 + pix_len, x0, x0 + pix_len)
+
+
+def extract_cutout(field_name, name, band, ra_ctr, dec_ctr, size_deg, field_dir, out_dir=None, pix_scale=1.5/3600., regrid=False, out_format='fits', float32=False, pyramid=0, bg_method='mean', bg_annulus=None, bg_reg_file=None):
+    # CUT ONE GALAXY OUT OF A FINISHED FIELD MOSAIC. BY DEFAULT THE CUTOUT IS
+    # A SUBARRAY ON THE FIELD'S OWN PROJECTION; WITH REGRID IT IS RESAMPLED
+    # ONTO THE USUAL GALAXY-CENTERED HEADER. FIELD MOSAICS KEEP THEIR
+    # BACKGROUND, SO IT IS REMOVED HERE FROM THE CUTOUT, FROM THE ANNULUS OR
+    # ELSE THE REGION FILE (DEFAULT: THE 30' GALEX ONE).
+    if bg_reg_file is None:
+        bg_reg_file = os.path.join(_HOME_DIR, 'galex_reprojected_bg.reg')
+    if out_dir is None:
+        out_dir = _MOSAIC_DIR
+    field_prefix = '_'.join([field_name, band]).upper()
+    planes = [('IMAGE', np.nan), ('WEIGHT', 0.), ('COUNT', 0.)]
+    pix_len = int(np.around(size_deg / pix_scale))
+    field_hdr = pyfits.getheader(product_file(field_dir, field_prefix, 'IMAGE'))
+
+    if regrid:
+        target_hdr = target_header(ra_ctr, dec_ctr, pix_len, pix_scale)[0]
+        section = tile_section(field_hdr, target_hdr)
+    else:
+        section = cutout_section(field_hdr, ra_ctr, dec_ctr, pix_len)
+        ny, nx = int(field_hdr['NAXIS2']), int(field_hdr['NAXIS1'])
+        y0, y1, x0, x1 = section
+        inner = (max(y0, 0), min(y1, ny), max(x0, 0), min(x1, nx))
+        if inner[0] >= inner[1] or inner[2] >= inner[3]:
+            inner = None
+    if section is None:
+        return None
+
+    gal_dir = os.path.join(_HOME_DIR, name + '_' + band + '_extract')
+    if not os.path.exists(gal_dir):
+        os.makedirs(gal_dir)
+
+    outfiles = []
+    for extname, blank in planes:
+        infile = product_file(field_dir, field_prefix, extname)
+        if regrid:
+            data, hdr = read_section(infile, section)
+            order = 0 if extname == 'COUNT' else 1
+            newdata = align.regrid(data, align.pixel_mapping(hdr, target_hdr), order=order)
+            newdata[~np.isfinite(newdata)] = blank
+            newhdr = target_hdr.copy()
+            newhdr['BUNIT'] = hdr.get('BUNIT', newhdr['BUNIT'])
+        else:
+            newdata = np.zeros((pix_len, pix_len)) + blank
+            if inner is not None:
+                data, hdr = read_section(infile, inner)
+                newdata[inner[0]-y0:inner[1]-y0, inner[2]-x0:inner[3]-x0] = data
+            newhdr = section_header(pyfits.getheader(infile), section)
+        newhdr['FIELD'] = field_name
+        outfile = os.path.join(gal_dir, extname.lower() + '_mosaic.fits')
+        pyfits.writeto(outfile, newdata, newhdr, overwrite=True)
+        outfiles.append(outfile)
+
+    remove_background(gal_dir, outfiles[0], bg_reg_file, method=bg_method, bg_annulus=bg_annulus)
+    mosaic_file = os.path.join(gal_dir, 'final_mosaic.fits')
+    pyramid_file = None
+    if pyramid > 0:
+        pyramid_file = build_pyramid(gal_dir, mosaic_file, outfiles[1], outfiles[2], pyramid)
+
+    write_products(name, band, mosaic_file, outfiles[1], outfiles[2], out_dir, out_format=out_format, float32=float32, pyramid_file=pyramid_file)
+    shutil.rmtree(gal_dir, ignore_errors=True)
+    return product_file(out_dir, '_'.join([name, band]).upper(), 'IMAGE')
+
+
+def unwise_tiles(index, band, ra_ctr, dec_ctr, size_deg):
     # CALCULATE TILE OVERLAP
     tile_overlaps = calc_tile_overlap(ra_ctr, dec_ctr, pad=size_deg,
                                       min_ra=index['MIN_RA'],
@@ -207,46 +474,7 @@ def unwise(band=None, ra_ctr=None, dec_ctr=None, size_deg=None, index=None, name
 
     # FIND OVERLAPPING TILES WITH RIGHT BAND
     #  index file set up such that index['BAND'] = 1, 2, 3, 4 depending on wise band
-    ind = np.where((index['BAND'] == band) & tile_overlaps)
-    ct_overlap = len(ind[0])
-
-    # SET UP THE OUTPUT
-    ri_targ, di_targ = make_axes(target_hdr)
-    sz_out = ri_targ.shape
-    outim = ri_targ * np.nan
-
-    # LOOP OVER OVERLAPPING TILES AND STITCH ONTO TARGET HEADER
-    for ii in range(0, ct_overlap):
-        infile = os.path.join(data_dir, index[ind[ii]]['FNAME'])
-        im, hdr = pyfits.getdata(infile, header=True)
-        ri, di = make_axes(hdr)
-
-        hh = pywcs.WCS(target_hdr)
-        x, y = ww.all_world2pix(zip(ri, di), 1)
-
-        in_image = (x > 0 & x < (sz_out[0]-1)) & (y > 0 and y < (sz_out[1]-1))
-        if np.sum(in_image) == 0:
-            print("No overlap. Proceeding.")
-            continue
-
-        if band == 1:
-            im *= w1_to_mjysr
-        if band == 2:
-            im *= w2_to_mjysr
-        if band == 3:
-            im *= w3_to_mjysr
-        if band == 4:
-            im *= w4_to_mjysr
-
-        target_hdr['BUNIT'] = 'MJY/SR'
-
-        newimfile = reprojection(infile, im, hdr, target_hdr, data_dir)
-        im, new_hdr = pyfits.getdata(newimfile, header=True)
-
-        useful = np.where(np.isfinite(im))
-        outim[useful] = im[useful]
-
-        return outim, target_hdr
+    return np.where((index['BAND'] == band) & tile_overlaps)
 
 
 def counts2jy(norm_mag, calibration_value, pix_as):
@@ -260,286 +488,176 @@ def counts2jy(norm_mag, calibration_value, pix_as):
     return val
 
 
+# UNWISE CALIBRATION TO GO FROM VEGAS TO ABMAG, PER BAND
+_UNWISE_VTOAB = {1: 2.683, 2: 3.319, 3: 5.242, 4: 6.604}
 
+# NORMALIZATION OF UNITY IN VEGAS MAG
+_UNWISE_NORM_MAG = 22.5
+_UNWISE_PIX_AS = 2.75  #arcseconds - native detector pixel size wise docs
 
-def galex(band='fuv', ra_ctr=None, dec_ctr=None, size_deg=None, index=None, name=None, write_info=True, model_bg=False):
-    tel = 'galex'
-    data_dir = os.path.join(_TOP_DIR, tel, 'sorted_tiles')
-    problem_file = os.path.join(_HOME_DIR, 'problem_galaxies.txt')
-    bg_reg_file = os.path.join(_HOME_DIR, 'galex_reprojected_bg.reg')
-    numbers_file = os.path.join(_HOME_DIR, 'gal_reproj_info.dat')
+# COUNTS TO MJY/SR CONVERSION, COMPUTED ONCE PER BAND
+UNWISE_TO_MJYSR = dict((band, counts2jy(_UNWISE_NORM_MAG, vtoab, _UNWISE_PIX_AS)) for band, vtoab in _UNWISE_VTOAB.items())
 
-    galaxy_mosaic_file = os.path.join(_MOSAIC_DIR, '_'.join([name, band]).upper() + '.FITS')
+# GALEX CALIBRATION FROM COUNTS TO ABMAG, PER BAND
+_GALEX_TOAB = {'fuv': 18.82, 'nuv': 20.08}
+_GALEX_PIX_AS = 1.5  # galex pixel scale -- from galex docs
 
-    start_time = time.time()
-    #if not os.path.exists(galaxy_mosaic_file):
-    if name == 'NGC2976':
-        print name
-        # READ THE INDEX FILE (IF NOT PASSED IN)
-        if index is None:
-            indexfile = os.path.join(_INDEX_DIR, tel + '_index_file.fits')
-            ext = 1
-            index, hdr = pyfits.getdata(indexfile, ext, header=True)
 
-        # CALIBRATION FROM COUNTS TO ABMAG
-        fuv_toab = 18.82
-        nuv_toab = 20.08
 
-        # PIXEL SCALE IN ARCSECONDS
-        pix_as = 1.5  # galex pixel scale -- from galex docs
 
-        # MAKE A HEADER
-        pix_scale = 1.5 / 3600.  # 1.5 arbitrary: how should I set it?
-        pix_len = size_deg / pix_scale
-        target_hdr = create_hdr(ra_ctr, dec_ctr, pix_len, pix_scale)
+def galex(band='fuv', ra_ctr=None, dec_ctr=None, size_deg=None, index=None, name=None, write_info=True, model_bg=False, prefetcher=None, out_format='fits', float32=False, pyramid=0, bg_method='mean', bg_annulus=None, tile_cache=None, out_dir=None, provider=None, coadd_mode='int', input_mode='int', sky_tol=0.05, subtract_bg=True):
+    # GALEX MOSAICS COME FROM THE SHARED SURVEY ENGINE (SEE surveys.py)
+    import surveys
+    return surveys.mosaic(surveys.GALEX, band, ra_ctr, dec_ctr, size_deg, name, index=index, write_info=write_info,
+                          model_bg=model_bg, prefetcher=prefetcher, provider=provider, out_dir=out_dir,
+                          out_format=out_format, float32=float32, pyramid=pyramid, bg_method=bg_method,
+                          bg_annulus=bg_annulus, tile_cache=tile_cache, coadd_mode=coadd_mode,
+                          input_mode=input_mode, sky_tol=sky_tol, subtract_bg=subtract_bg)
 
-        # CALCULATE TILE OVERLAP
-        tile_overlaps = calc_tile_overlap(ra_ctr, dec_ctr, pad=size_deg,
-                                          min_ra=index['MIN_RA'],
-                                          max_ra=index['MAX_RA'],
-                                          min_dec=index['MIN_DEC'],
-                                          max_dec=index['MAX_DEC'])
 
-        # FIND OVERLAPPING TILES WITH RIGHT BAND
-        #  index file set up such that index['fuv'] = 1 where fuv and
-        #                              index['nuv'] = 1 where nuv
-        ind = np.where((index[band]) & tile_overlaps)
+def read_index(tel):
+    indexfile = os.path.join(_INDEX_DIR, tel + '_index_file.fits')
+    ext = 1
+    index, hdr = pyfits.getdata(indexfile, ext, header=True)
+    return index
 
-        # MAKE SURE THERE ARE OVERLAPPING TILES
-        ct_overlap = len(ind[0])
-        if ct_overlap == 0:
-            with open(problem_file, 'a') as myfile:
-                myfile.write(name + ': ' + 'No overlapping tiles\n')
-            return
-
-        # SET UP THE OUTPUT
-        ri_targ, di_targ = make_axes(target_hdr)
-        sz_out = ri_targ.shape
-        outim = ri_targ * np.nan
-        prihdu = pyfits.PrimaryHDU(data=outim, header=target_hdr)
-        target_hdr = prihdu.header
 
+def galex_tiles(index, band, ra_ctr, dec_ctr, size_deg):
+    # CALCULATE TILE OVERLAP
+    tile_overlaps = calc_tile_overlap(ra_ctr, dec_ctr, pad=size_deg,
+                                      min_ra=index['MIN_RA'],
+                                      max_ra=index['MAX_RA'],
+                                      min_dec=index['MIN_DEC'],
+                                      max_dec=index['MAX_DEC'])
 
+    # FIND OVERLAPPING TILES WITH RIGHT BAND
+    #  index file set up such that index['fuv'] = 1 where fuv and
+    #                              index['nuv'] = 1 where nuv
+    return np.where((index[band]) & tile_overlaps)
+
+
+def galex_tile_files(index, ind, data_dir, product='int'):
+    # ARCHIVE PATHS OF THE INT (OR CNT, INTBGSUB), RRHR AND FLAG FILES FOR THE SELECTED TILES
+    infiles = [os.path.join(data_dir, f) for f in index[ind[0]]['fname']]
+    if product != 'int':
+        infiles = [f.replace('-int.fits', '-' + product + '.fits') for f in infiles]
+    wtfiles = [os.path.join(data_dir, f) for f in index[ind[0]]['rrhrfile']]
+    flgfiles = [os.path.join(data_dir, f) for f in index[ind[0]]['flagfile']]
+    return infiles, wtfiles, flgfiles
+
+
+def local_file(archive_file, prefetcher=None, provider=None, optional=False):
+    # THE PREFETCHED LOCAL COPY OF A TILE WHEN IT EXISTS, OTHERWISE WHEREVER
+    # THE PROVIDER HAS IT. AN OPTIONAL FILE THE PROVIDER CANNOT FIND KEEPS
+    # ITS (MISSING) ARCHIVE PATH.
+    infile = archive_file
+    if prefetcher is not None:
+        infile = prefetcher.local_path(archive_file)
+    if provider is not None and infile == archive_file:
         try:
-            # CREATE NEW TEMP DIRECTORY TO STORE TEMPORARY FILES
-            gal_dir = os.path.join(_HOME_DIR, name)
-            os.makedirs(gal_dir)
-
-
-            # GATHER THE INPUT FILES
-            im_dir, wt_dir, nfiles = get_input(index, ind, data_dir, gal_dir)
-
-
-            # CONVERT INT FILES TO MJY/SR AND WRITE NEW FILES INTO TEMP DIR
-            im_dir, wt_dir = convert_files(gal_dir, im_dir, wt_dir, band, fuv_toab, nuv_toab, pix_as)
-
-
-            # APPEND UNIT INFORMATION TO THE NEW HEADER AND WRITE OUT HEADER FILE
-            target_hdr['BUNIT'] = 'MJY/SR'
-            hdr_file = os.path.join(gal_dir, name + '_template.hdr')
-            write_headerfile(hdr_file, target_hdr)
-
-
-            # MASK IMAGES
-            im_dir, wt_dir = mask_images(im_dir, wt_dir, gal_dir)
-
-
-            # REPROJECT IMAGES
-            reprojected_dir = os.path.join(gal_dir, 'reprojected')
-            os.makedirs(reprojected_dir)
-            im_dir = reproject_images(hdr_file, im_dir, reprojected_dir, 'int')
-            wt_dir = reproject_images(hdr_file, wt_dir, reprojected_dir,'rrhr')
-
-
-            # MODEL THE BACKGROUND IN THE IMAGE FILES?
-            if model_bg:
-                im_dir = bg_model(gal_dir, im_dir, hdr_file)
-
-
-            # WEIGHT IMAGES
-            weight_dir = os.path.join(gal_dir, 'weight')
-            os.makedirs(weight_dir)
-            im_dir, wt_dir = weight_images(im_dir, wt_dir, weight_dir)
-
-
-            # CREATE THE METADATA TABLES NEEDED FOR COADDITION
-            weight_table = create_table(wt_dir, dir_type='weights')
-            weighted_table = create_table(im_dir, dir_type='int')
-            count_table = create_table(im_dir, dir_type='count')
-
-
-            # COADD THE REPROJECTED, WEIGHTED IMAGES AND THE WEIGHT IMAGES
-            final_dir = os.path.join(gal_dir, 'mosaic')
-            os.makedirs(final_dir)
-            coadd(hdr_file, final_dir, wt_dir, output='weights')
-            coadd(hdr_file, final_dir, im_dir, output='int')
-            coadd(hdr_file, final_dir, im_dir, output='count',add_type='count')
-
-
-            # DIVIDE OUT THE WEIGHTS
-            imagefile = finish_weight(final_dir)
-
-
-            # SUBTRACT OUT THE BACKGROUND
-            remove_background(final_dir, imagefile, bg_reg_file)
-
-
-            # COPY MOSAIC FILES TO CUTOUTS DIRECTORY
-            mosaic_file = os.path.join(final_dir, 'final_mosaic.fits')
-            weight_file = os.path.join(final_dir, 'weights_mosaic.fits')
-            count_file = os.path.join(final_dir, 'count_mosaic.fits')
-            newfile = '_'.join([name, band]).upper() + '.FITS'
-            wt_file = '_'.join([name, band]).upper() + '_weight.FITS'
-            ct_file = '_'.join([name, band]).upper() + '_count.FITS'
-            new_mosaic_file = os.path.join(_MOSAIC_DIR, newfile)
-            new_weight_file = os.path.join(_MOSAIC_DIR, wt_file)
-            new_count_file = os.path.join(_MOSAIC_DIR, ct_file)
-            shutil.copy(mosaic_file, new_mosaic_file)
-            shutil.copy(weight_file, new_weight_file)
-            shutil.copy(count_file, new_count_file)
-
-
-            # REMOVE GALAXY DIRECTORY AND EXTRA FILES
-            shutil.rmtree(gal_dir, ignore_errors=True)
-
-
-            # NOTE TIME TO FINISH
-            stop_time = time.time()
-            total_time = (stop_time - start_time) / 60.
-
-
-            # WRITE OUT THE NUMBER OF TILES THAT OVERLAP THE GIVEN GALAXY
-            out_arr = [name, nfiles, np.around(total_time, 2)]
-            with open(numbers_file, 'a') as nfile:
-                nfile.write('{0: >10}'.format(out_arr[0]))
-                nfile.write('{0: >6}'.format(out_arr[1]))
-                nfile.write('{0: >6}'.format(out_arr[2]) + '\n')
-                #nfile.write(name + ': ' + str(len(infiles)) + '\n')
-
-        # SOMETHING WENT WRONG
-        except Exception as inst:
-            me = sys.exc_info()[0]
-            with open(problem_file, 'a') as myfile:
-                myfile.write(name + ': ' + str(me) + ': '+str(inst)+'\n')
-            shutil.rmtree(gal_dir, ignore_errors=True)
-
-    return
-
-
-def get_input(index, ind, data_dir, gal_dir):
-    input_dir = os.path.join(gal_dir, 'input')
-    os.makedirs(input_dir)
-    infiles = index[ind[0]]['fname']
-    wtfiles = index[ind[0]]['rrhrfile']
-    flgfiles = index[ind[0]]['flagfile']
-    infiles = [os.path.join(data_dir, f) for f in infiles]
-    wtfiles = [os.path.join(data_dir, f) for f in wtfiles]
-    flgfiles = [os.path.join(data_dir, f) for f in flgfiles]
-
-    for infile in infiles:
-        basename = os.path.basename(infile)
-        new_in_file = os.path.join(input_dir, basename)
-        os.symlink(infile, new_in_file)
-
-    for wtfile in wtfiles:
-        basename = os.path.basename(wtfile)
-        new_wt_file = os.path.join(input_dir, basename)
-        os.symlink(wtfile, new_wt_file)
-
-    for flgfile in flgfiles:
-        basename = os.path.basename(flgfile)
-        new_flg_file = os.path.join(input_dir, basename)
-        os.symlink(flgfile, new_flg_file)
-
-    return input_dir, input_dir, len(infiles)
-
-
-def convert_files(gal_dir, im_dir, wt_dir, band, fuv_toab, nuv_toab, pix_as):
-    converted_dir = os.path.join(gal_dir, 'converted')
-    os.makedirs(converted_dir)
-
-    intfiles = sorted(glob.glob(os.path.join(im_dir, '*-int.fits')))
-    wtfiles = sorted(glob.glob(os.path.join(wt_dir, '*-rrhr.fits')))
-
-    int_outfiles = [os.path.join(converted_dir, os.path.basename(f).replace('.fits', '_mjysr.fits')) for f in intfiles]
-    wt_outfiles = [os.path.join(converted_dir, os.path.basename(f)) for f in wtfiles]
-
-    for i in range(len(intfiles)):
-        if os.path.exists(wtfiles[i]):
-            im, hdr = pyfits.getdata(intfiles[i], header=True)
-            wt, whdr = pyfits.getdata(wtfiles[i], header=True)
-            #wt = wtpersr(wt, pix_as)
-            if band.lower() == 'fuv':
-                im = counts2jy_galex(im, fuv_toab, pix_as)
-            if band.lower() == 'nuv':
-                im = counts2jy_galex(im, nuv_toab, pix_as)
-            if not os.path.exists(int_outfiles[i]):
-                im -= np.mean(im)
-                pyfits.writeto(int_outfiles[i], im, hdr)
-            if not os.path.exists(wt_outfiles[i]):
-                pyfits.writeto(wt_outfiles[i], wt, whdr)
+            infile = provider.local_path(archive_file)
+        except IOError:
+            if not optional:
+                raise
+    return infile
+
+
+def converted_name(f, product='int'):
+    # NAME OF A TILE AFTER surveys.prepare_tiles: CALIBRATED INTENSITY MAPS GAIN _mjysr
+    if product != 'cnt':
+        return os.path.basename(f).replace('.fits', '_mjysr.fits')
+    return os.path.basename(f)
+
+
+# ARCHIVE SKY STATISTICS OF EACH WHOLE TILE, KEYED BY (SKY FILE, MTIME, STEP)
+_SKY_CACHE = {}
+
+
+def tile_sky_stats(skyfile, imfile, step=8):
+    # MEAN ARCHIVE SKY LEVEL AND MEDIAN OF THE SKY-SUBTRACTED TILE OVER THE
+    # EXPOSED PIXELS (SKY > 0), BOTH IN COUNTS/S, FROM EVERY STEP-TH ROW OF
+    # THE WHOLE TILE SO THEY DO NOT DEPEND ON THE SECTION A CUTOUT USES.
+    # NONE WHEN THERE IS NO SKY MAP OR NO EXPOSED PIXEL.
+    if not os.path.exists(skyfile):
+        return None
+    key = (os.path.realpath(skyfile), os.path.getmtime(skyfile), step)
+    if key not in _SKY_CACHE:
+        with pyfits.open(skyfile, memmap=True) as skylist, pyfits.open(imfile, memmap=True) as imlist:
+            sky = np.array(skylist[0].section[::step, :])
+            im = np.array(imlist[0].section[::step, :])
+        good = np.isfinite(sky) & (sky > 0)
+        if sky.shape == im.shape:
+            good &= np.isfinite(im)
+        if not np.any(good) or sky.shape != im.shape:
+            _SKY_CACHE[key] = None
         else:
-            continue
-
-    return converted_dir, converted_dir
-
+            _SKY_CACHE[key] = (float(np.mean(sky[good])), float(np.median(im[good])))
+    return _SKY_CACHE[key]
 
-def mask_images(im_dir, wt_dir, gal_dir):
-    masked_dir = os.path.join(gal_dir, 'masked')
-    os.makedirs(masked_dir)
 
-    int_masked_dir = os.path.join(masked_dir, 'int')
-    wt_masked_dir = os.path.join(masked_dir, 'rrhr')
-    os.makedirs(int_masked_dir)
-    os.makedirs(wt_masked_dir)
+def sky_matched(im_dir, tol=0.05):
+    # TRUE WHEN THE RESIDUAL SKY LEVELS OF THE TILES AGREE TO WITHIN TOL OF
+    # THE TYPICAL SKY, SO MODELING THE BACKGROUND WOULD GAIN LITTLE. EVERY
+    # TILE NEEDS SKY STATISTICS (SKYSTAT) AND THERE MUST BE AT LEAST TWO.
+    hdrs = [pyfits.getheader(f) for f in glob.glob(os.path.join(im_dir, '*.fits'))]
+    if len(hdrs) < 2 or not all(h.get('SKYSTAT', False) for h in hdrs):
+        return False
+    resid = np.array([h['SKYRESID'] for h in hdrs])
+    level = np.median([h['SKYLEVEL'] for h in hdrs])
+    return np.ptp(resid) <= tol * level
 
-    int_suff, rrhr_suff = '*_mjysr.fits', '*-rrhr.fits'
-    int_images = sorted(glob.glob(os.path.join(im_dir, int_suff)))
-    rrhr_images = sorted(glob.glob(os.path.join(wt_dir, rrhr_suff)))
 
-    for i in range(len(int_images)):
-        image_infile = int_images[i]
-        wt_infile = rrhr_images[i]
+# GALEX FLAG BITS THAT MARK ARTIFACTS: 2 = WINDOW REFLECTION, 4 = DICHROIC REFLECTION
+_FLAG_BITS = 2 | 4
 
-        image_outfile = os.path.join(int_masked_dir, os.path.basename(image_infile))
-        wt_outfile = os.path.join(wt_masked_dir, os.path.basename(wt_infile))
 
-        mask_galex(image_infile, wt_infile, out_intfile=image_outfile, out_wtfile=wt_outfile)
+def flag_factor(hdr, fhdr):
+    # HOW MANY INTENSITY PIXELS ACROSS ONE FLAG PIXEL
+    return max(int(np.around(abs(float(fhdr['CDELT1']) / float(hdr['CDELT1'])))), 1)
 
-    return int_masked_dir, wt_masked_dir
 
+def apply_flag_mask(arr, bad, factor, value):
+    # SET EVERY PIXEL UNDER A BAD FLAG PIXEL TO VALUE, IN PLACE. THE ARRAY IS
+    # VIEWED AS FACTOR X FACTOR BLOCKS AND THE FLAGS ARE BROADCAST ACROSS
+    # EACH BLOCK, SO NO FULL RESOLUTION MASK IS EVER MADE.
+    ny, nx = arr.shape
+    fy, fx = -(-ny // factor), -(-nx // factor)
+    bad = bad[:fy, :fx]
+    if ny % factor == 0 and nx % factor == 0 and bad.shape == (fy, fx):
+        blocks = arr.reshape(fy, factor, fx, factor)
+        np.copyto(blocks, value, where=bad[:, None, :, None])
+    else:
+        # RAGGED EDGE OF A TILE: FALL BACK TO AN EXPLICIT UPSAMPLING
+        upbad = np.repeat(np.repeat(bad, factor, axis=0), factor, axis=1)[:ny, :nx]
+        arr[:upbad.shape[0], :upbad.shape[1]][upbad] = value
+    return arr
 
-def mask_galex(intfile, wtfile, outfile=None, chip_rad = 1400, chip_x0=1920, chip_y0=1920, out_intfile=None, out_wtfile=None):
-
-    if out_intfile is None:
-        out_intfile = intfile.replace('.fits', '_masked.fits')
-    if out_wtfile is None:
-        out_wtfile = wtfile.replace('.fits', '_masked.fits')
-
-    if not os.path.exists(out_intfile):
-        data, hdr = pyfits.getdata(intfile, header=True)
-        wt, whdr = pyfits.getdata(wtfile, header=True)
-        #flag, fhdr = pyfits.getdata(flagfile, header=True)
-
-        #factor = float(len(data)) / len(flag)
-        #upflag = zoom(flag, factor, order=0)
 
-        x = np.arange(data.shape[1]).reshape(1, -1) + 1
-        y = np.arange(data.shape[0]).reshape(-1, 1) + 1
-        r = np.sqrt((x - chip_x0)**2 + (y - chip_y0)**2)
+def galex_chip_mask(data, wt, hdr, flag=None, fhdr=None, chip_rad=1400, chip_x0=1920, chip_y0=1920):
+    # BLANK THE DETECTOR EDGE, MISSING EXPOSURE AND FLAGGED ARTIFACTS
+    # DATA MAY BE A SECTION OF THE TILE; MEASURE RADII IN TILE PIXELS
+    x = np.arange(data.shape[1]).reshape(1, -1) + 1 - hdr.get('LTV1', 0)
+    y = np.arange(data.shape[0]).reshape(-1, 1) + 1 - hdr.get('LTV2', 0)
+    r = np.sqrt((x - chip_x0)**2 + (y - chip_y0)**2)
 
-        i = (r > chip_rad)
-        j = (data == 0)
-        k = (wt == -1.1e30)
+    i = (r > chip_rad)
+    j = (data == 0)
+    k = (wt == -1.1e30)
 
-        data = np.where(i | k, 0, data)  #0
-        wt = np.where(i | k, 1e-20, wt) #1e-20
+    data = np.where(i | k, 0, data)  #0
+    wt = np.where(i | k, 1e-20, wt) #1e-20
 
-        pyfits.writeto(out_intfile, data, hdr)
-        pyfits.writeto(out_wtfile, wt, whdr)
+    # ARTIFACTS FROM THE FLAG MAP
+    if flag is not None:
+        bad = (flag.astype(int) & _FLAG_BITS) != 0
+        factor = flag_factor(hdr, fhdr)
+        apply_flag_mask(data, bad, factor, 0)
+        apply_flag_mask(wt, bad, factor, 1e-20)
+    return data, wt
 
 
 def reproject_images(template_header, input_dir, reprojected_dir, imtype, whole=False, exact=True, img_list=None):
+    import montage_wrapper as montage
 
     reproj_imtype_dir = os.path.join(reprojected_dir, imtype)
     os.makedirs(reproj_imtype_dir)
@@ -558,6 +676,7 @@ def reproject_images(template_header, input_dir, reprojected_dir, imtype, whole=
 
 
 def bg_model(gal_dir, reprojected_dir, template_header, level_only=False):
+    import montage_wrapper as montage
     bg_model_dir = os.path.join(gal_dir, 'background_model')
     os.makedirs(bg_model_dir)
 
@@ -594,8 +713,8 @@ def bg_model(gal_dir, reprojected_dir, template_header, level_only=False):
     return corr_dir
 
 
-def weight_images(im_dir, wt_dir, weight_dir):
-    im_suff, wt_suff = '*_mjysr.fits', '*-rrhr.fits'
+def weight_images(im_dir, wt_dir, weight_dir, wt_suff='*-rrhr.fits'):
+    im_suff = '*_mjysr.fits'
     imfiles = sorted(glob.glob(os.path.join(im_dir, im_suff)))
     wtfiles = sorted(glob.glob(os.path.join(wt_dir, wt_suff)))
 
@@ -636,6 +755,7 @@ def weight_images(im_dir, wt_dir, weight_dir):
 
 
 def create_table(in_dir, dir_type=None):
+    import montage_wrapper as montage
     if dir_type is None:
         reprojected_table = os.path.join(in_dir, 'reprojected.tbl')
     else:
@@ -667,6 +787,7 @@ def wtpersr(wt, pix_as):
 
 
 def coadd(template_header, output_dir, input_dir, output=None, add_type=None):
+    import montage_wrapper as montage
     img_dir = input_dir
     # output is either 'weights' or 'int'
     if output is None:
@@ -678,6 +799,23 @@ def coadd(template_header, output_dir, input_dir, output=None, add_type=None):
     montage.mAdd(reprojected_table, template_header, out_image, img_dir=img_dir, exact=True, type=add_type)
 
 
+def finish_rate(output_dir, factor):
+    # COUNT RATE FROM THE COADDED COUNTS AND EXPOSURE (THE SAME INPUTS ENTER
+    # BOTH MEANS, SO THIS IS SUM(CNT) / SUM(EXP)), CONVERTED TO MJY/SR ONCE
+    image_file = os.path.join(output_dir, 'cnt_mosaic.fits')
+    wt_file = os.path.join(output_dir, 'weights_mosaic.fits')
+    cnt, hdr = pyfits.getdata(image_file, header=True)
+    exp = pyfits.getdata(wt_file)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        newim = cnt / exp * factor
+    hdr['BUNIT'] = 'MJY/SR'
+
+    newfile = os.path.join(output_dir, 'image_mosaic.fits')
+    pyfits.writeto(newfile, newim, hdr)
+    return newfile
+
+
 def finish_weight(output_dir):
     image_file = os.path.join(output_dir, 'int_mosaic.fits')
     wt_file = os.path.join(output_dir, 'weights_mosaic.fits')
@@ -693,29 +831,253 @@ def finish_weight(output_dir):
     return newfile
 
 
-def remove_background(final_dir, imfile, bgfile):
+def block_sum(data):
+    # SUM OVER 2X2 BLOCKS, DROPPING AN ODD LAST ROW OR COLUMN
+    ny, nx = (data.shape[0] // 2) * 2, (data.shape[1] // 2) * 2
+    return data[:ny, :nx].reshape(ny // 2, 2, nx // 2, 2).sum(axis=3).sum(axis=1)
+
+
+def pyramid_header(hdr, level):
+    # WCS OF AN IMAGE BINNED BY 2**LEVEL: PIXEL EDGE 0.5 STAYS ON EDGE 0.5
+    factor = 2**level
+    hdr = hdr.copy()
+    for ax in ['1', '2']:
+        hdr['CRPIX' + ax] = (hdr['CRPIX' + ax] - 0.5) / factor + 0.5
+        if 'CDELT' + ax in hdr:
+            hdr['CDELT' + ax] *= factor
+    for key in ['CD1_1', 'CD1_2', 'CD2_1', 'CD2_2']:
+        if key in hdr:
+            hdr[key] *= factor
+    hdr['PYRLEVEL'] = level
+    return hdr
+
+
+def build_pyramid(final_dir, imfile, wtfile, ctfile, nlevels):
+    # WEIGHT-AWARE 2X2 BLOCK-AVERAGED PYRAMID IN ONE PASS OVER THE MOSAIC.
+    # THE MOSAIC IS READ IN STRIPS OF 2**NLEVELS ROWS SO EVERY LEVEL CAN BE
+    # FORMED FROM THE STRIP IN MEMORY. THE IMAGE IS AVERAGED WITH THE WEIGHT
+    # MAP (OR THE COUNT MAP IF THERE IS NO WEIGHT MAP); WEIGHTS AND COUNTS
+    # ARE SUMMED.
+    im_hdul = pyfits.open(imfile, memmap=True)
+    ct_hdul = pyfits.open(ctfile, memmap=True)
+    wt_hdul = pyfits.open(wtfile, memmap=True) if wtfile is not None else ct_hdul
+    im, wt, ct = im_hdul[0].data, wt_hdul[0].data, ct_hdul[0].data
+    hdr = im_hdul[0].header
+
+    strip = 2**nlevels
+    levels = [[[], [], []] for i in range(nlevels)]
+    for y0 in range(0, im.shape[0], strip):
+        this_im = np.asarray(im[y0:y0+strip], dtype=float)
+        this_wt = np.asarray(wt[y0:y0+strip], dtype=float)
+        this_ct = np.asarray(ct[y0:y0+strip], dtype=float)
+
+        good = np.isfinite(this_im) & np.isfinite(this_wt)
+        w = np.where(good, this_wt, 0.)
+        wim = np.where(good, this_im, 0.) * w
+        n = np.where(np.isfinite(this_ct), this_ct, 0.)
+
+        for level in range(nlevels):
+            if min(w.shape) < 2:
+                break
+            wim, w, n = block_sum(wim), block_sum(w), block_sum(n)
+            levels[level][0].append(wim)
+            levels[level][1].append(w)
+            levels[level][2].append(n)
+
+    hdus = [pyfits.PrimaryHDU()]
+    for level in range(nlevels):
+        if len(levels[level][0]) == 0:
+            break
+        wim, w, n = [np.concatenate(arrs, axis=0) for arrs in levels[level]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            level_im = np.where(w != 0, wim / w, np.nan)
+        level_hdr = pyramid_header(hdr, level + 1)
+        hdus.append(pyfits.ImageHDU(data=level_im, header=level_hdr, name='IMAGE' + str(level+1)))
+        hdus.append(pyfits.ImageHDU(data=w, header=level_hdr, name='WEIGHT' + str(level+1)))
+        hdus.append(pyfits.ImageHDU(data=n, header=level_hdr, name='COUNT' + str(level+1)))
+
+    for hdul in [im_hdul, wt_hdul, ct_hdul]:
+        hdul.close()
+
+    outfile = os.path.join(final_dir, 'pyramid_mosaic.fits')
+    pyfits.HDUList(hdus).writeto(outfile)
+    return outfile
+
+
+def write_runtime(numbers_file, survey, name, nfiles, minutes, npix):
+    # ONE TAB-SEPARATED ROW PER RUN: SURVEY, NAME, NFILES, MINUTES, NPIX.
+    # READ BACK BY planner.read_runtimes TO CALIBRATE THE COST MODEL.
+    out_arr = [survey, name, nfiles, np.around(minutes, 2), int(npix)]
+    with open(numbers_file, 'a') as nfile:
+        nfile.write('\t'.join([str(x) for x in out_arr]) + '\n')
+
+
+def remove_background(final_dir, imfile, bgfile, method='mean', bg_annulus=None):
+    # BACKGROUND SAMPLES COME FROM THE PIXEL-SPACE REGION FILE OR, IF GIVEN,
+    # FROM SECTORS OF AN ANNULUS AROUND THE GALAXY (SEE bg_annulus_indices)
     data, hdr = pyfits.getdata(imfile, header=True)
-    box_inds = read_bg_regfile(bgfile)
-    allvals = []
-    sample_means = []
-    for box in box_inds:
-        rectangle = zip(box[0::2], box[1::2])
-        sample = get_bg_sample(data, hdr, rectangle)
-        for s in sample:
-            allvals.append(s)
-        sample_mean = np.nanmean(sample)
-        sample_means.append(sample_mean)
-    this_mean = np.around(np.nanmean(sample_means), 8)
-
-    final_data = data - this_mean
-    hdr['BG'] = this_mean
+    if bg_annulus is None:
+        boxes = read_bg_regfile(bgfile)
+        nbox = len(boxes)
+        flat_inds, box_ids = bg_box_indices(data.shape, boxes)
+    else:
+        nbox = bg_annulus.get('nsectors', 8)
+        flat_inds, box_ids = bg_annulus_indices(hdr, **bg_annulus)
+    this_bg, box_stats = estimate_background(data, flat_inds, box_ids, nbox, method=method)
+    this_bg = np.around(this_bg, 8)
+
+    final_data = data - this_bg
+    hdr['BG'] = this_bg
+    hdr['BGMETHOD'] = method
     hdr['comment'] = 'Background has been subtracted.'
 
     outfile = os.path.join(final_dir, 'final_mosaic.fits')
     pyfits.writeto(outfile, final_data, hdr)
+    return this_bg, box_stats
+
+
+# FLAT PIXEL INDICES OF THE BACKGROUND BOXES, KEYED BY (IMAGE SHAPE, BOXES)
+_BG_INDEX_CACHE = {}
+
+
+def bg_box_indices(shape, boxes):
+    # FLAT INDICES OF THE PIXELS INSIDE EACH POLYGON AND THE BOX EACH BELONGS
+    # TO. ONLY THE PIXELS IN A POLYGON'S BOUNDING BOX ARE TESTED.
+    key = (tuple(shape), tuple(tuple(box) for box in boxes))
+    if key in _BG_INDEX_CACHE:
+        return _BG_INDEX_CACHE[key]
+    from matplotlib.path import Path
+
+    ny, nx = shape
+    all_inds, all_ids = [], []
+    for i, box in enumerate(boxes):
+        verts = np.column_stack([box[0::2], box[1::2]]).astype(float)
+        x0, x1 = max(int(np.floor(verts[:, 0].min())), 0), min(int(np.ceil(verts[:, 0].max())) + 1, nx)
+        y0, y1 = max(int(np.floor(verts[:, 1].min())), 0), min(int(np.ceil(verts[:, 1].max())) + 1, ny)
+        if (x0 >= x1) or (y0 >= y1):
+            continue
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        xx, yy = xx.ravel(), yy.ravel()
+        sel = Path(verts).contains_points(np.column_stack([xx, yy]))
+        all_inds.append(yy[sel] * nx + xx[sel])
+        all_ids.append(np.zeros(np.sum(sel), dtype=int) + i)
+
+    if len(all_inds) == 0:
+        result = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+    else:
+        result = (np.concatenate(all_inds), np.concatenate(all_ids))
+    _BG_INDEX_CACHE[key] = result
+    return result
+
+
+# FLAT PIXEL INDICES OF BACKGROUND ANNULI, KEYED BY (TARGET GRID, ANNULUS).
+# AN ANNULUS BELONGS TO ONE GALAXY AND IS ONLY REUSED BY ITS OTHER BANDS, SO
+# JUST THE MOST RECENT FEW ARE KEPT.
+_BG_ANNULUS_CACHE = collections.OrderedDict()
+_BG_ANNULUS_CACHE_SIZE = 4
+
+
+def bg_annulus_indices(hdr, ra_ctr=None, dec_ctr=None, inner=None, outer=None, units='r25', r25_deg=None, incl_deg=0., posang_deg=0., nsectors=8):
+    # PIXELS BETWEEN INNER AND OUTER GALACTOCENTRIC RADIUS, SPLIT INTO
+    # NSECTORS AZIMUTHAL SECTORS THAT PLAY THE ROLE OF BACKGROUND BOXES.
+    # RADII ARE IN UNITS OF R25 OR ARCSEC AND ARE MEASURED IN THE PLANE OF
+    # THE GALAXY WHEN AN INCLINATION AND POSITION ANGLE ARE GIVEN. THE
+    # RASTERIZED SECTORS ARE CACHED PER TARGET GRID, SO ANY CUTOUT SIZE CAN
+    # REUSE ONE DEFINITION.
+    if not np.isfinite(incl_deg):
+        incl_deg = 0.
+    if not np.isfinite(posang_deg):
+        posang_deg = 0.
+    if units == 'r25':
+        scale = r25_deg
+    elif units == 'arcsec':
+        scale = 1. / 3600.
+    else:
+        raise ValueError('Unknown annulus units: ' + units)
+
+    key = (align.grid_key(hdr), ra_ctr, dec_ctr, inner * scale, outer * scale, incl_deg, posang_deg, nsectors)
+    if key in _BG_ANNULUS_CACHE:
+        result = _BG_ANNULUS_CACHE.pop(key)
+        _BG_ANNULUS_CACHE[key] = result
+        return result
+
+    ny, nx = int(hdr['NAXIS2']), int(hdr['NAXIS1'])
+    yy, xx = np.mgrid[0:ny, 0:nx]
+    ra, dec = pywcs.WCS(hdr, naxis=2).all_pix2world(xx.ravel(), yy.ravel(), 0)
+    xi, eta, cos_c = tangent_plane(ra, dec, ra_ctr, dec_ctr)
+    xi, eta = np.degrees(xi), np.degrees(eta)
+
+    # ROTATE TO THE MAJOR AXIS (PA EAST OF NORTH) AND STRETCH THE MINOR AXIS
+    pa, incl = np.radians(posang_deg), np.radians(incl_deg)
+    x_maj = xi * np.sin(pa) + eta * np.cos(pa)
+    # THE AXIS RATIO IS FLOORED AT 0.2 (AS IN planner.cutout_size_deg) SO
+    # EDGE-ON GALAXIES STILL HAVE A FINITE ANNULUS
+    x_min = (xi * np.cos(pa) - eta * np.sin(pa)) / max(np.cos(incl), 0.2)
+    rad = np.sqrt(x_maj**2 + x_min**2)
+    theta = np.arctan2(x_min, x_maj) % (2. * np.pi)
+
+    sel = (rad >= inner * scale) & (rad < outer * scale)
+    flat_inds = np.where(sel)[0]
+    box_ids = np.minimum((theta[sel] / (2. * np.pi) * nsectors).astype(int), nsectors - 1)
+    order = np.argsort(box_ids, kind='mergesort')
+
+    result = (flat_inds[order], box_ids[order])
+    _BG_ANNULUS_CACHE[key] = result
+    while len(_BG_ANNULUS_CACHE) > _BG_ANNULUS_CACHE_SIZE:
+        _BG_ANNULUS_CACHE.popitem(last=False)
+    return result
+
+
+def estimate_background(data, flat_inds, box_ids, nbox, method='mean', nsigma=3., niter=10):
+    # BACKGROUND FROM THE BOX SAMPLES: THE MEAN OF THE PER-BOX MEAN, MEDIAN
+    # OR SIGMA-CLIPPED MEAN. ALL BOXES ARE HANDLED AT ONCE BY PACKING THE
+    # SAMPLES INTO A NAN-PADDED (NBOX, NMAX) ARRAY.
+    vals = np.ravel(data)[flat_inds].astype(float)
+    npix = np.bincount(box_ids, minlength=nbox)
+    starts = np.concatenate([[0], np.cumsum(npix)[:-1]])
+    pos = np.arange(len(box_ids)) - np.repeat(starts, npix)
+    samples = np.zeros((nbox, max(npix.max(), 1) if nbox > 0 else 1)) + np.nan
+    samples[box_ids, pos] = vals
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if method == 'sigclip':
+            for i in range(niter):
+                med = np.nanmedian(samples, axis=1)[:, None]
+                std = np.nanstd(samples, axis=1)[:, None]
+                clip = np.abs(samples - med) > nsigma * std
+                if not np.any(clip):
+                    break
+                samples[clip] = np.nan
+            box_values = np.nanmean(samples, axis=1)
+        elif method == 'median':
+            box_values = np.nanmedian(samples, axis=1)
+        elif method == 'mean':
+            box_values = np.nanmean(samples, axis=1)
+        else:
+            raise ValueError('Unknown background method: ' + method)
+
+        box_stats = {'value': box_values,
+                     'mean': np.nanmean(samples, axis=1),
+                     'median': np.nanmedian(samples, axis=1),
+                     'std': np.nanstd(samples, axis=1),
+                     'npix': np.sum(np.isfinite(samples), axis=1)}
+        bg = np.nanmean(box_values)
+    return bg, box_stats
+
+
+# PARSED REGION FILES, KEYED BY (PATH, MODIFICATION TIME)
+_REGFILE_CACHE = {}
 
 
 def read_bg_regfile(regfile):
+    key = (regfile, os.path.getmtime(regfile))
+    if key not in _REGFILE_CACHE:
+        _REGFILE_CACHE[key] = parse_bg_regfile(regfile)
+    return _REGFILE_CACHE[key]
+
+
+def parse_bg_regfile(regfile):
     f = open(regfile, 'r')
     boxes = f.readlines()
     f.close()
@@ -726,15 +1088,3 @@ def read_bg_regfile(regfile):
         [this_box.append(int(np.around(float(bb), 0))) for bb in box]
         box_list.append(this_box)
     return box_list
-
-
-def get_bg_sample(data, hdr, box):
-    wcs = pywcs.WCS(hdr, naxis=2)
-    x, y = np.arange(data.shape[0]), np.arange(data.shape[1])
-    X, Y = np.meshgrid(x, y, indexing='ij')
-    xx, yy = X.flatten(), Y.flatten()
-    pixels = np.array(zip(yy, xx))
-    box_coords = box
-    sel = Path(box_coords).contains_points(pixels)
-    sample = data.flatten()[sel]
-    return sample
@@ -0,0 +1,77 @@
+import os
+import sys
+import subprocess
+
+
+# A MANUAL CHECK, NOT PART OF ANY TEST SUITE: RUN IT BY HAND (python
+# import_budget.py) WITH THE PIPELINE'S OWN INTERPRETER AFTER CHANGING
+# MODULE-LEVEL IMPORTS. IT EXITS NONZERO WHEN A MODULE IS OVER BUDGET OR
+# FAILS TO IMPORT.
+
+# PACKAGES THAT ONLY THE STAGES USING THEM SHOULD LOAD
+_HEAVY = ['montage_wrapper', 'matplotlib', 'scipy']
+
+# IMPORT ONE MODULE IN A FRESH INTERPRETER; PRINT THE SECONDS IT TOOK AND
+# WHICH HEAVY PACKAGES CAME WITH IT
+_PROBE = """
+import sys, time
+t0 = time.time()
+import {module}
+print(time.time() - t0)
+print(' '.join(sorted(set(m.split('.')[0] for m in sys.modules if m.split('.')[0] in {heavy!r}))))
+"""
+
+
+def import_cost(module, repeat=3, heavy=_HEAVY):
+    # BEST OF REPEAT COLD IMPORTS OF MODULE FROM THIS DIRECTORY, AND THE
+    # HEAVY PACKAGES IT PULLED IN. RAISES CalledProcessError IF THE IMPORT FAILS.
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    best, loaded = None, []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', _PROBE.format(module=module, heavy=list(heavy))], cwd=code_dir,
+                                      stderr=subprocess.STDOUT)
+        lines = out.decode('ascii', 'replace').splitlines()
+        seconds = float(lines[-2])
+        loaded = lines[-1].split()
+        if best is None or seconds < best:
+            best = seconds
+    return best, loaded
+
+
+def check(modules, budget=1.0, repeat=3):
+    # TRUE IF EVERY MODULE IMPORTS WITHIN BUDGET SECONDS WITHOUT ANY HEAVY PACKAGE
+    ok = True
+    for module in modules:
+        try:
+            seconds, loaded = import_cost(module, repeat=repeat)
+        except subprocess.CalledProcessError as inst:
+            # REPORT THE LAST LINE OF THE TRACEBACK AND GO ON TO THE NEXT MODULE
+            lines = inst.output.decode('ascii', 'replace').strip().splitlines()
+            print('{0: <16}{1: >8} s  {2: <5}{3}'.format(module, '-', 'FAIL', lines[-1] if len(lines) > 0 else ''))
+            ok = False
+            continue
+        status = 'ok'
+        if seconds > budget or len(loaded) > 0:
+            status = 'OVER'
+            ok = False
+        print('{0: <16}{1: >8.3f} s  {2: <5}{3}'.format(module, seconds, status, ' '.join(loaded)))
+    return ok
+
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser(description='Manual check (not a test) that the pipeline modules import quickly and without the heavy stage dependencies.')
+    parser.add_argument('modules', nargs='*', default=['extract_stamp', 'surveys', 'planner', 'manifest', 'make_cutouts'], help='modules to import. Default: the pipeline entry points.')
+    parser.add_argument('--budget', default=1.0, type=float, help='seconds allowed per module import. Default: 1.0.')
+    parser.add_argument('--repeat', default=3, type=int, help='number of cold imports to take the best of. Default: 3.')
+    return parser.parse_args()
+
+
+def main(**kwargs):
+    if not check(kwargs['modules'], budget=kwargs['budget'], repeat=kwargs['repeat']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    args = get_args()
+    main(**vars(args))
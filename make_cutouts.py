@@ -4,24 +4,122 @@ import config
 from pdb import set_trace
 import gal_data
 import extract_stamp
+import prefetch
+import convolution
+import align
+import staging
+import cutout_store
+import planner
+import manifest
+import providers
+import surveys
 import warnings
+import shutil
+import os
+import sys
 
 _OUT_DIR = '../cutouts/sings/'
 _MIPS_DIR = '/data/tycho/0/leroy.42/ellohess/data/mips/sings/'
 _LOS_DIR = '../../ellohess/code/index/'
 _KERNEL_DIR = '/data/tycho/0/leroy.42/ellohess/kernels/Low_Resolution/'
+_TABLE_FILE = '/data/tycho/0/leroy.42/allsky/galex/MyAllSkyTable_akleroy.csv'
 _TEST_WRITE_DIR = '/n/home00/lewis.1590/research/galbase_allsky/cutouts/'
 
 def get_args():
     import argparse
     parser = argparse.ArgumentParser(description='Create cutouts of a given size around each galaxy center.')
-    parser.add_argument('--size', default=30, help='cutout size in arcminutes. Default: 30.')
+    parser.add_argument('--size', default=30, type=float, help='cutout size in arcminutes. Default: 30.')
+    parser.add_argument('--adaptive', action='store_true', help='size each cutout from the galaxy r25 instead of --size (still used for galaxies without r25).')
+    parser.add_argument('--size_factor', default=4., type=float, help='adaptive cutout side in units of r25. Default: 4.')
+    parser.add_argument('--min_size', default=5., type=float, help='smallest adaptive cutout in arcminutes. Default: 5.')
+    parser.add_argument('--max_size', default=120., type=float, help='largest adaptive cutout in arcminutes. Default: 120.')
+    parser.add_argument('--use_shape', action='store_true', help='use inclination and position angle when sizing adaptive cutouts.')
+    parser.add_argument('--plan', action='store_true', help='print the cutout sizes, tile counts, predicted costs and worker assignments and stop.')
+    parser.add_argument('--nworkers', default=1, type=int, help='number of workers the galaxies are packed across. Default: 1.')
+    parser.add_argument('--worker_id', default=0, type=int, help='which of the --nworkers job lists this process runs; --nworkers itself runs the cutouts over --mem_budget, alone. Default: 0.')
+    parser.add_argument('--mem_budget', default=None, type=float, help='memory per worker in GB; larger cutouts are left for a serial pass. Default: no limit.')
+    parser.add_argument('--affinity', action='store_true', help='keep galaxies that share tiles on one worker and convert and mask each tile once per cluster.')
+    parser.add_argument('--min_overlap', default=0.3, type=float, help='tile-set Jaccard index above which two galaxies are clustered. Default: 0.3.')
+    parser.add_argument('--tile_cache', default=None, help='directory for the per-cluster tile cache. Default: tile_cache in the home directory.')
+    parser.add_argument('--super_mosaic', action='store_true', help='build one mosaic per cluster of galaxies and cut each galaxy out of it.')
+    parser.add_argument('--max_field', default=3., type=float, help='largest cluster side in degrees, for the tile cache and super-mosaics; bigger clusters are split. Default: 3.')
+    parser.add_argument('--regrid', action='store_true', help='resample super-mosaic cutouts onto galaxy-centered headers instead of taking subarrays.')
+    parser.add_argument('--cost_file', default=None, help='past runtimes used to calibrate the cost model. Default: gal_reproj_info.dat in the home directory.')
+    parser.add_argument('--manifest', default=None, help='write the download commands for every tile the planned cutouts need to this file and stop.')
+    parser.add_argument('--table', default=_TABLE_FILE, help='all-sky table of download commands used for --manifest.')
+    parser.add_argument('--products', default=['int', 'rrhr', 'flags'], nargs='+', help='tile products to list with --manifest. Default: int rrhr flags.')
     parser.add_argument('--cutout', action='store_true')
     parser.add_argument('--copy', action='store_true')
     parser.add_argument('--convolve', action='store_true')
     parser.add_argument('--align', action='store_true')
     parser.add_argument('--model_bg', action='store_true', help='model the background to match all images as best as possible.')
-    return parser.parse_args()
+    parser.add_argument('--kernel_target', default='Gauss_15', help='PSF to convolve cutouts to with --convolve. Default: Gauss_15.')
+    parser.add_argument('--align_band', default=None, help='band whose header the other bands are aligned to. Default: first available.')
+    parser.add_argument('--out_format', default='fits', choices=['fits', 'packed', 'compressed'], help='layout of the final products. Default: fits (three files).')
+    parser.add_argument('--float32', action='store_true', help='write the final products as float32.')
+    parser.add_argument('--pyramid', default=0, type=int, help='number of 2x2 binned levels to store with each product. Default: 0 (none).')
+    parser.add_argument('--store', default=None, help='also append every finished cutout to this chunked catalog store directory (a fixed number of append-only shard files).')
+    parser.add_argument('--unwise', action='store_true', help='also make unWISE W1-W4 cutouts.')
+    parser.add_argument('--mips', action='store_true', help='also make MIPS 24, 70 and 160 micron cutouts from the SINGS maps.')
+    parser.add_argument('--coadd_mode', default='int', choices=['int', 'cnt'], help='coadd calibrated intensity tiles weighted by exposure (int), or raw counts and exposure divided at the end (cnt). Default: int.')
+    parser.add_argument('--input_mode', default='int', choices=['int', 'intbgsub'], help='start from the archive intensity tiles (int) or the sky-subtracted tiles with their sky maps (intbgsub). Default: int.')
+    parser.add_argument('--sky_tol', default=0.05, type=float, help='with --input_mode intbgsub, skip the background model when the residual sky of the tiles agrees to this fraction of the sky level. Default: 0.05.')
+    parser.add_argument('--bg_method', default='mean', choices=['mean', 'median', 'sigclip'], help='statistic used in each background box. Default: mean.')
+    parser.add_argument('--bg_annulus', default=None, type=float, nargs=2, metavar=('INNER', 'OUTER'), help='sample the background in an annulus around each galaxy instead of the region file. Default with --adaptive: 0.6-0.95 of half the cutout side.')
+    parser.add_argument('--bg_units', default='r25', choices=['r25', 'arcsec'], help='units of --bg_annulus radii. Default: r25.')
+    parser.add_argument('--prefetch', default=0, type=int, help='copy the tiles of the next N galaxies into local scratch while working. Default: 0 (off).')
+    parser.add_argument('--fetch_missing', action='store_true', help='download tiles missing from the local archive into --fetch_cache.')
+    parser.add_argument('--fetch_cache', default='/tmp/galbase_tiles', help='local cache for downloaded tiles.')
+    parser.add_argument('--cache_size', default=500., type=float, help='size of --fetch_cache in GB. Default: 500.')
+    parser.add_argument('--base_url', default=None, help='server to download tiles from instead of the one in --table.')
+    parser.add_argument('--scratch_dir', default='/tmp/galbase_prefetch', help='node-local directory for prefetched tiles.')
+    args = parser.parse_args()
+    if args.coadd_mode == 'cnt' and args.input_mode == 'intbgsub':
+        parser.error('--coadd_mode cnt coadds the count maps and cannot use --input_mode intbgsub')
+    return args
+
+
+def get_galaxies(tag='SINGS'):
+    gals = gal_data.gal_data(tag=tag)
+    galaxies = []
+    for i in range(len(gals)):
+        this_gal = np.rec.fromarrays(gals[i], names=list(config.COLUMNS))
+        galname = str(this_gal.name).replace(' ', '').upper()
+        galaxies.append((galname, this_gal.ra_deg, this_gal.dec_deg, gals[i]))
+    return galaxies
+
+
+# WITHOUT --bg_annulus AN ADAPTIVE CUTOUT SAMPLES ITS BACKGROUND IN THIS
+# CIRCULAR ANNULUS, AS FRACTIONS OF HALF THE CUTOUT SIDE. THE REGION FILE IS
+# DRAWN FOR 30' CUTOUTS AND DOES NOT FIT ANY OTHER SIZE.
+_ADAPTIVE_ANNULUS = (0.6, 0.95)
+
+
+def get_bg_annulus(galaxy, radii, units, size_deg=None):
+    # ANNULUS DEFINITION FOR remove_background. WITH NO RADII (OR NO R25 FOR
+    # R25 UNITS) AN ADAPTIVE CUTOUT OF SIDE SIZE_DEG GETS THE DEFAULT ANNULUS
+    # AND A FIXED-SIZE CUTOUT FALLS BACK TO THE REGION FILE (NONE).
+    galname, ra_ctr, dec_ctr, row = galaxy
+    r25_deg = float(row['R25_DEG'])
+    if radii is None or (units == 'r25' and not np.isfinite(r25_deg)):
+        if size_deg is None:
+            return None
+        half_as = size_deg / 2. * 3600.
+        return {'ra_ctr': ra_ctr, 'dec_ctr': dec_ctr, 'inner': _ADAPTIVE_ANNULUS[0] * half_as,
+                'outer': _ADAPTIVE_ANNULUS[1] * half_as, 'units': 'arcsec'}
+    return {'ra_ctr': ra_ctr, 'dec_ctr': dec_ctr, 'inner': radii[0], 'outer': radii[1],
+            'units': units, 'r25_deg': r25_deg, 'incl_deg': float(row['INCL_DEG']),
+            'posang_deg': float(row['POSANG_DEG'])}
+
+
+def schedule_galaxy(prefetcher, index, key, galaxy, bands, size_deg, product='int'):
+    galname, ra_ctr, dec_ctr = galaxy[:3]
+    files = []
+    for band in bands:
+        ind = surveys.GALEX.tiles(index, band, ra_ctr, dec_ctr, size_deg)
+        infiles, wtfiles, extras = surveys.GALEX.tile_files(index, ind, band, product=product)
+        files += infiles + wtfiles + [f for extra in extras for f in extra]
+    prefetcher.schedule(key, files)
 
 
 def main(**kwargs):
@@ -29,27 +127,192 @@ def main(**kwargs):
     if kwargs['cutout']:
         warnings.filterwarnings('ignore')
 
-        gals = gal_data.gal_data(tag='SINGS')
-        n_gals = len(gals)
+        galaxies = get_galaxies(tag='SINGS')
         size_deg = kwargs['size'] * 60. / 3600.
+        bands = ['fuv'] # 'nuv'
+        product = 'cnt' if kwargs['coadd_mode'] == 'cnt' else kwargs['input_mode']
+
+        # READ THE INDEX ONCE AND WORK OUT THE SIZE OF EVERY CUTOUT
+        index = extract_stamp.read_index('galex')
+        plan = planner.plan_sizes(galaxies, index, band=bands[0], adaptive=kwargs['adaptive'], fixed_deg=size_deg,
+                                  factor=kwargs['size_factor'], min_deg=kwargs['min_size'] / 60.,
+                                  max_deg=kwargs['max_size'] / 60., default_deg=size_deg,
+                                  use_shape=kwargs['use_shape'])
+
+        # PREDICT THE COST OF EACH GALAXY FROM PAST RUNS AND PACK THEM ACROSS
+        # WORKERS LONGEST FIRST
+        cost_file = kwargs['cost_file']
+        if cost_file is None:
+            cost_file = os.path.join(extract_stamp._HOME_DIR, 'gal_reproj_info.dat')
+        coeffs = planner.fit_cost_model(planner.read_runtimes(cost_file, default_npix=(size_deg / (1.5 / 3600.))**2, survey='galex'))
+        plan = planner.predict_costs(plan, coeffs)
+        mem_budget = None
+        if kwargs['mem_budget'] is not None:
+            mem_budget = kwargs['mem_budget'] * 1024.**3
+        # CLUSTERS ARE KEPT UNDER --max_field, AND WITH SUPER-MOSAICS UNDER THE
+        # SIDE OF THE LARGEST FIELD THAT FITS IN THE MEMORY BUDGET
+        clusters = None
+        if kwargs['affinity'] or kwargs['super_mosaic']:
+            max_field = kwargs['max_field']
+            if kwargs['super_mosaic'] and mem_budget is not None:
+                max_field = min(max_field, planner.max_field_deg(mem_budget))
+            clusters = planner.tile_clusters(plan, min_overlap=kwargs['min_overlap'], max_size_deg=max_field)
+        jobs, too_big = planner.pack_jobs(plan, kwargs['nworkers'], mem_budget=mem_budget, groups=clusters, fields=kwargs['super_mosaic'])
+
+        # WHICH CLUSTER EACH GALAXY BELONGS TO
+        cluster_of = {}
+        if clusters is not None:
+            for c, members in enumerate(clusters):
+                for i in members:
+                    cluster_of[i] = c
+
+        # GALAXIES OVER THE MEMORY BUDGET GO TO ONE EXTRA JOB, --worker_id
+        # NWORKERS, TO BE RUN ON ITS OWN ONCE THE OTHER WORKERS ARE DONE
+        if len(too_big) > 0:
+            jobs.append(sorted(too_big, key=lambda i: -plan[i]['cost']))
+            for i in too_big:
+                print(plan[i]['name'] + ' needs ' + str(np.around(plan[i]['memory'] / 1024.**3, 2)) + ' GB; queued for the serial pass (--worker_id ' + str(kwargs['nworkers']) + ').')
+
+        if kwargs['plan']:
+            for w, job in enumerate(jobs):
+                for i in job:
+                    p = plan[i]
+                    c = cluster_of.get(i, -1)
+                    print('{0: >4} {1: >5} {2: >12} {3: >8.4f} {4: >5} {5: >10.2f}'.format(w, c, p['name'], p['size_deg'], p['ntiles'], p['cost']))
+            return
+
+        if kwargs['manifest'] is not None:
+            tiles = set()
+            for job in jobs:
+                for i in job:
+                    tiles |= plan[i]['tiles']
+            table = manifest.read_table(kwargs['table'])
+            bases = manifest.index_bases(index, (np.array(sorted(tiles), dtype=int),))
+            for base in manifest.missing_bases(table, bases):
+                print(base + ' is not in ' + kwargs['table'])
+            nlines = manifest.write_manifest(kwargs['manifest'], manifest.manifest_lines(table, bases=bases, products=kwargs['products']))
+            print('Wrote ' + str(nlines) + ' commands to ' + kwargs['manifest'])
+            return
+
+        if kwargs['worker_id'] < 0 or kwargs['worker_id'] >= len(jobs):
+            sys.exit('--worker_id ' + str(kwargs['worker_id']) + ' is out of range: there are ' + str(len(jobs)) +
+                     ' job lists (0-' + str(len(jobs) - 1) + ')' + ('' if len(too_big) > 0 else ' and no serial pass') + '.')
+        order = jobs[kwargs['worker_id']]
+        n_jobs = len(order)
+
+        # THE SHARED TILE CACHE AND THE FIELD MOSAICS OF EACH CLUSTER
+        tile_cache, fields = None, {}
+        field_dir = os.path.join(extract_stamp._HOME_DIR, 'fields')
+        if clusters is not None:
+            for c, members in enumerate(clusters):
+                if kwargs['super_mosaic'] and len(members) > 1:
+                    field = planner.field_extent(plan, members)
+                    if field[2] <= max_field:
+                        fields[c] = field
+            cache_root = kwargs['tile_cache']
+            if cache_root is None:
+                cache_root = os.path.join(extract_stamp._HOME_DIR, 'tile_cache')
+
+        # WHERE TILES COME FROM: THE LOCAL ARCHIVE ONLY, OR DOWNLOADED ON DEMAND.
+        # THE DOWNLOAD TABLE ONLY LISTS GALEX TILES, SO THE OTHER SURVEYS ALWAYS
+        # READ THEIR LOCAL ARCHIVE.
+        data_dir = os.path.join(extract_stamp._TOP_DIR, 'galex', 'sorted_tiles')
+        if kwargs['fetch_missing']:
+            provider = providers.FetchOnMiss(data_dir, kwargs['fetch_cache'], manifest.read_table(kwargs['table']),
+                                             max_bytes=kwargs['cache_size'] * 1024.**3, base_url=kwargs['base_url'])
+        else:
+            provider = providers.LocalArchive()
+        local_provider = providers.LocalArchive()
+
+        # START COPYING TILES FOR THE FIRST GALAXIES
+        prefetcher = None
+        n_ahead = kwargs['prefetch']
+        if n_ahead > 0:
+            prefetcher = prefetch.TilePrefetcher(kwargs['scratch_dir'])
+            for k in range(min(n_ahead, n_jobs)):
+                schedule_galaxy(prefetcher, index, order[k], galaxies[order[k]], bands, plan[order[k]]['size_deg'], product=product)
+
+        # THE OTHER SURVEYS RUN THROUGH THE SAME ENGINE AS GALEX, EACH WITH ITS
+        # INDEX READ ONCE
+        others = []
+        if kwargs['unwise']:
+            others.append((surveys.UNWISE, surveys.UNWISE.read_index()))
+        if kwargs['mips']:
+            mips = surveys.Mips(_MIPS_DIR)
+            others.append((mips, mips.read_index()))
+
+        for k, i in enumerate(order):
+            galname, ra_ctr, dec_ctr = galaxies[i][:3]
+            size_deg = plan[i]['size_deg']
+            if prefetcher is not None and k + n_ahead < n_jobs:
+                j = order[k + n_ahead]
+                schedule_galaxy(prefetcher, index, j, galaxies[j], bands, plan[j]['size_deg'], product=product)
+
+            # START A NEW TILE CACHE AT THE FIRST GALAXY OF EACH CLUSTER
+            if kwargs['affinity'] and (tile_cache is None or tile_cache['cluster'] != cluster_of[i]):
+                c = cluster_of[i]
+                tile_cache = {'cluster': c, 'dir': os.path.join(cache_root, 'cluster' + str(c)),
+                              'hdr': planner.cluster_header(plan, clusters[c])}
+
+            bg_annulus = get_bg_annulus(galaxies[i], kwargs['bg_annulus'], kwargs['bg_units'],
+                                        size_deg=size_deg if kwargs['adaptive'] else None)
+            c = cluster_of.get(i)
+            if c in fields:
+                # ONE SHARED MOSAIC FOR THE WHOLE FIELD (MADE BY ITS FIRST
+                # GALAXY), THEN A CUTOUT FROM IT FOR THIS GALAXY WITH ITS OWN
+                # BACKGROUND AND PYRAMID. FIELD RUNS ARE NOT RECORDED IN
+                # gal_reproj_info.dat: THEY WOULD SKEW THE PER-GALAXY COST MODEL
+                field_name = 'FIELD' + str(c)
+                field_ra, field_dec, field_size = fields[c]
+                for band in bands:
+                    field_file = os.path.join(field_dir, '_'.join([field_name, band]).upper() + '.FITS')
+                    if not os.path.exists(field_file):
+                        surveys.mosaic(surveys.GALEX, band, field_ra, field_dec, field_size, field_name, index=index, write_info=False, model_bg=kwargs['model_bg'], prefetcher=prefetcher, bg_method=kwargs['bg_method'], out_dir=field_dir, provider=provider, coadd_mode=kwargs['coadd_mode'], input_mode=kwargs['input_mode'], sky_tol=kwargs['sky_tol'], subtract_bg=False)
+                    if os.path.exists(field_file):
+                        extract_stamp.extract_cutout(field_name, galname, band, ra_ctr, dec_ctr, size_deg, field_dir, regrid=kwargs['regrid'], out_format=kwargs['out_format'], float32=kwargs['float32'], pyramid=kwargs['pyramid'], bg_method=kwargs['bg_method'], bg_annulus=bg_annulus)
+            else:
+                for band in bands:
+                    surveys.mosaic(surveys.GALEX, band, ra_ctr, dec_ctr, size_deg, galname, index=index, model_bg=kwargs['model_bg'], prefetcher=prefetcher, out_format=kwargs['out_format'], float32=kwargs['float32'], pyramid=kwargs['pyramid'], bg_method=kwargs['bg_method'], bg_annulus=bg_annulus, tile_cache=tile_cache, provider=provider, coadd_mode=kwargs['coadd_mode'], input_mode=kwargs['input_mode'], sky_tol=kwargs['sky_tol'])
+
+            for survey, survey_index in others:
+                for band in survey.bands:
+                    surveys.mosaic(survey, band, ra_ctr, dec_ctr, size_deg, galname, index=survey_index, model_bg=kwargs['model_bg'], prefetcher=prefetcher, provider=local_provider, out_format=kwargs['out_format'], float32=kwargs['float32'], pyramid=kwargs['pyramid'], bg_method=kwargs['bg_method'], bg_annulus=bg_annulus)
+
+            # APPEND THIS GALAXY'S PRODUCTS TO THE CATALOG STORE
+            if kwargs['store'] is not None:
+                attrs = cutout_store.row_to_dict(galaxies[i][3])
+                store_bands = bands + [survey.bandname(b) for survey, survey_index in others for b in survey.bands]
+                cutout_store.add_galaxy(kwargs['store'], galname, store_bands, extract_stamp._MOSAIC_DIR, attrs=attrs)
 
-        for i in range(n_gals):
-            this_gal = np.rec.fromarrays(gals[i], names=list(config.COLUMNS))
-            galname = str(this_gal.name).replace(' ', '').upper()
+            if prefetcher is not None:
+                prefetcher.release(i)
 
-            extract_stamp.galex(band='fuv', ra_ctr=this_gal.ra_deg, dec_ctr=this_gal.dec_deg, size_deg=size_deg, name=galname, model_bg=kwargs['model_bg'])
+            # DROP THE TILE CACHE ONCE THE CLUSTER IS FINISHED
+            if tile_cache is not None and (k + 1 == n_jobs or cluster_of[order[k + 1]] != tile_cache['cluster']):
+                shutil.rmtree(tile_cache['dir'], ignore_errors=True)
 
-            #extract_stamp.galex(band='nuv', ra_ctr=this_gal.ra_deg, dec_ctr=this_gal.dec_deg, size_deg=size_deg, name=galname, model_bg=kwargs['model_bg'])
+        if prefetcher is not None:
+            prefetcher.close()
 
 
     if kwargs['copy']:
-        pass
+        # STAGE ALL FINISHED PRODUCTS TO THE OUTPUT ARCHIVE IN ONE BATCH
+        counts = staging.stage_tree(extract_stamp._MOSAIC_DIR, _OUT_DIR)
+        print('Staged products: ' + str(counts))
 
     if kwargs['convolve']:
-        pass
+        conv_dir = os.path.join(extract_stamp._MOSAIC_DIR, 'convolved')
+        convolution.convolve_cutouts(extract_stamp._MOSAIC_DIR, conv_dir, _KERNEL_DIR, target=kwargs['kernel_target'])
 
     if kwargs['align']:
-        pass
+        # ALIGN THE CONVOLVED CUTOUTS IF THEY EXIST, THE NATIVE ONES OTHERWISE
+        in_dir = os.path.join(extract_stamp._MOSAIC_DIR, 'convolved')
+        if not os.path.exists(in_dir):
+            in_dir = extract_stamp._MOSAIC_DIR
+        align_dir = os.path.join(extract_stamp._MOSAIC_DIR, 'aligned')
+        for galname, ra_ctr, dec_ctr, row in get_galaxies(tag='SINGS'):
+            files = align.band_files(in_dir, galname, mips_dir=_MIPS_DIR)
+            align.align_galaxy(galname, files, align_dir, ref_band=kwargs['align_band'])
 
 
 
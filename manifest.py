@@ -0,0 +1,90 @@
+import numpy as np
+import os
+
+
+# GALEX PRODUCT SUFFIXES, AS IN AIS_183_sg55-fd-int.fits.gz
+_PRODUCTS = ['int', 'flags', 'cnt', 'exp', 'intbgsub', 'skybg', 'wt', 'rrhr']
+
+
+def split_names(files):
+    # TILE BASE NAME AND PRODUCT OF EVERY FILE NAME OR URL, E.G.
+    # .../AIS_183_sg55-fd-int.fits.gz -> (AIS_183_sg55-fd, int)
+    fnames = np.char.rpartition(np.char.strip(np.asarray(files, dtype=str), ' "\n'), '/')[:, 2]
+    parts = np.char.rpartition(fnames, '-')
+    product = np.char.partition(parts[:, 2], '.')[:, 0]
+    return parts[:, 0], product
+
+
+def read_table(infile):
+    # ONE ROW PER DOWNLOAD COMMAND IN THE ALL-SKY TABLE (E.G.
+    # MyAllSkyTable_akleroy.csv, WHOSE LAST FIELD IS THE QUOTED URL). RETURNS
+    # THE COMMANDS WITH THE BASE NAME AND PRODUCT OF EACH.
+    with open(infile) as f:
+        lines = np.array(f.read().splitlines()[1:])
+    lines = lines[np.char.str_len(np.char.strip(lines)) > 0]
+    urls = np.char.rpartition(lines, ' ')[:, 2]
+    base, product = split_names(urls)
+    table = np.rec.fromarrays([lines, base, product], names=['line', 'base', 'product'])
+    return table[np.isin(product, _PRODUCTS)]
+
+
+def unique_tiles(table):
+    # FIRST ROW OF EVERY TILE, WHATEVER PRODUCT IT LISTS
+    bases, first = np.unique(table['base'], return_index=True)
+    return table[first]
+
+
+def index_bases(index, ind, column='fname'):
+    # BASE NAMES OF THE TILES SELECTED FROM A TELESCOPE INDEX, E.G. BY
+    # extract_stamp.galex_tiles
+    return np.unique(split_names(index[ind[0]][column])[0])
+
+
+def manifest_lines(table, bases=None, products=('int', 'rrhr', 'flags')):
+    # DOWNLOAD COMMANDS FOR EVERY PRODUCT OF EVERY REQUESTED TILE, GROUPED BY
+    # PRODUCT. EACH COMMAND IS THE TABLE'S OWN COMMAND FOR THAT TILE WITH THE
+    # PRODUCT SUFFIX SWAPPED.
+    tiles = unique_tiles(table)
+    if bases is not None:
+        tiles = tiles[np.isin(tiles['base'], bases)]
+
+    lines = []
+    for new in products:
+        if new not in _PRODUCTS:
+            raise ValueError('Unknown product: ' + new)
+        for old in np.unique(tiles['product']):
+            rows = tiles['line'][tiles['product'] == old]
+            lines.append(np.char.replace(rows, '-' + old + '.', '-' + new + '.'))
+    if len(lines) == 0:
+        return []
+    return np.concatenate(lines).tolist()
+
+
+def missing_bases(table, bases):
+    # REQUESTED TILES THAT THE TABLE DOES NOT LIST
+    return np.setdiff1d(bases, table['base'])
+
+
+def write_manifest(outfile, lines):
+    out_dir = os.path.dirname(os.path.abspath(outfile))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with open(outfile + '.tmp', 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+    os.rename(outfile + '.tmp', outfile)
+    return len(lines)
+
+
+def manifest_urls(lines):
+    # THE URL AT THE END OF EACH DOWNLOAD COMMAND
+    lines = np.asarray(lines, dtype=str)
+    return np.char.strip(np.char.rpartition(lines, ' ')[:, 2], ' "\n').tolist()
+
+
+def read_manifest(infile):
+    with open(infile) as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    if len(lines) == 0:
+        return []
+    return manifest_urls(lines)
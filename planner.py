@@ -0,0 +1,259 @@
+import numpy as np
+import os
+import re
+import heapq
+import extract_stamp
+
+
+def cutout_size_deg(r25_deg, incl_deg=np.nan, posang_deg=np.nan, factor=4., min_deg=5./60., max_deg=2., default_deg=0.5, use_shape=False):
+    # SIDE OF A SQUARE CUTOUT SCALED TO THE GALAXY: FACTOR TIMES R25 FOR A
+    # FACE-ON DISK. WITH USE_SHAPE THE PROJECTED ELLIPSE (AXIS RATIO FROM THE
+    # INCLINATION, ORIENTED BY THE POSITION ANGLE) SETS THE EXTENT INSTEAD.
+    # GALAXIES WITHOUT R25 GET THE DEFAULT SIZE. THE RESULT IS CLAMPED.
+    if not np.isfinite(r25_deg) or r25_deg <= 0:
+        return default_deg
+
+    half_x, half_y = r25_deg, r25_deg
+    if use_shape and np.isfinite(incl_deg) and np.isfinite(posang_deg):
+        a = r25_deg
+        b = r25_deg * max(np.cos(np.radians(incl_deg)), 0.2)
+        pa = np.radians(posang_deg)
+        half_x = np.sqrt((a * np.sin(pa))**2 + (b * np.cos(pa))**2)
+        half_y = np.sqrt((a * np.cos(pa))**2 + (b * np.sin(pa))**2)
+
+    size = factor * max(half_x, half_y)
+    return float(np.clip(size, min_deg, max_deg))
+
+
+def work_estimate(size_deg, pix_scale_deg, ntiles):
+    # OUTPUT PIXELS TIMES OVERLAPPING TILES: EVERY TILE IS REPROJECTED ONTO
+    # THE FULL TARGET GRID
+    npix = (size_deg / pix_scale_deg)**2
+    return npix * ntiles
+
+
+def plan_sizes(galaxies, index, band='fuv', pix_scale_deg=1.5/3600., adaptive=True, fixed_deg=0.5, **policy):
+    # SIZE, TILE COUNT AND WORK ESTIMATE FOR EVERY GALAXY, IN INPUT ORDER.
+    # GALAXIES ARE (NAME, RA, DEC, GAL_DATA ROW) AS FROM make_cutouts.get_galaxies.
+    plan = []
+    for galname, ra_ctr, dec_ctr, row in galaxies:
+        if adaptive:
+            size_deg = cutout_size_deg(float(row['R25_DEG']), incl_deg=float(row['INCL_DEG']),
+                                       posang_deg=float(row['POSANG_DEG']), **policy)
+        else:
+            size_deg = fixed_deg
+        tiles = set()
+        if index is not None:
+            tiles = set(extract_stamp.galex_tiles(index, band, ra_ctr, dec_ctr, size_deg)[0].tolist())
+        plan.append({'name': galname, 'ra': float(ra_ctr), 'dec': float(dec_ctr), 'size_deg': size_deg,
+                     'ntiles': len(tiles), 'tiles': tiles,
+                     'work': work_estimate(size_deg, pix_scale_deg, len(tiles))})
+    return plan
+
+
+# MINUTES = C0 + C1 * NFILES + C2 * NFILES * MEGAPIXELS, USED UNTIL THERE ARE
+# ENOUGH PAST RUNS TO FIT
+_DEFAULT_COEFFS = np.array([0.5, 0.2, 0.05])
+
+# BYTES HELD PER OUTPUT PIXEL AT THE PEAK OF A RUN (MOSAIC, WEIGHT, COUNT,
+# BACKGROUND AND THE PRODUCT COPIES, ALL FLOAT64)
+_BYTES_PER_PIX = 8 * 6
+
+
+def _legacy_runtime(line):
+    # OLD FIXED-WIDTH ROWS: NAME RIGHT-ALIGNED IN 10 CHARACTERS (LONGER NAMES
+    # OVERFLOW), THEN NFILES AND MINUTES IN 6 EACH AND NPIX IN 10. THE FIELDS
+    # RUN TOGETHER ONCE A RUN TAKES 100 MINUTES, SO SLICE BY WIDTH.
+    name = line.split()[0]
+    end = max(10, line.index(name) + len(name))
+    fields = [line[end:end+6], line[end+6:end+12], line[end+12:end+22]]
+    return ['galex', name] + [f.strip() for f in fields if f.strip()]
+
+
+def read_runtimes(numbers_file, default_npix=None, survey='galex'):
+    # PAST RUNS OF ONE SURVEY FROM gal_reproj_info.dat: TAB-SEPARATED SURVEY,
+    # NAME, NFILES, MINUTES AND NPIX (SEE extract_stamp.write_runtime). OLDER
+    # FIXED-WIDTH ROWS ARE GALEX RUNS AND MAY LACK NPIX; THEY GET DEFAULT_NPIX.
+    # ROWS LEFT BY SUPER-MOSAIC FIELDS (FIELDn) ARE NOT GALAXY RUNS AND ARE SKIPPED.
+    rows = []
+    if not os.path.exists(numbers_file):
+        return rows
+    with open(numbers_file) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if len(line.strip()) == 0:
+                continue
+            if '\t' in line:
+                parts = line.split('\t')
+            else:
+                parts = _legacy_runtime(line)
+            if len(parts) < 4 or parts[0] != survey or re.match(r'FIELD\d+$', parts[1]):
+                continue
+            try:
+                nfiles, minutes = int(parts[2]), float(parts[3])
+                npix = float(parts[4]) if len(parts) > 4 else default_npix
+            except ValueError:
+                continue
+            if npix is not None and nfiles > 0:
+                rows.append((parts[1], nfiles, minutes, npix))
+    return rows
+
+
+def cost_terms(nfiles, npix):
+    nfiles = np.asarray(nfiles, dtype=float)
+    npix = np.asarray(npix, dtype=float)
+    return np.array([np.ones_like(nfiles), nfiles, nfiles * npix / 1e6]).T
+
+
+def fit_cost_model(rows, min_rows=5):
+    # NON-NEGATIVE LEAST SQUARES FIT OF THE COST TERMS TO PAST RUNTIMES
+    if len(rows) < min_rows:
+        return _DEFAULT_COEFFS.copy()
+    from scipy.optimize import nnls
+    nfiles = [r[1] for r in rows]
+    npix = [r[3] for r in rows]
+    minutes = np.array([r[2] for r in rows])
+    coeffs, resid = nnls(cost_terms(nfiles, npix), minutes)
+    return coeffs
+
+
+def predict_costs(plan, coeffs, pix_scale_deg=1.5/3600.):
+    # ADD PREDICTED MINUTES AND PEAK MEMORY (BYTES) TO EVERY PLAN ENTRY
+    for p in plan:
+        npix = (p['size_deg'] / pix_scale_deg)**2
+        p['cost'] = float(np.dot(cost_terms([p['ntiles']], [npix])[0], coeffs)) if p['ntiles'] > 0 else 0.
+        p['memory'] = npix * _BYTES_PER_PIX
+    return plan
+
+
+def pack_jobs(plan, nworkers, mem_budget=None, groups=None, fields=False, pix_scale_deg=1.5/3600.):
+    # LONGEST PROCESSING TIME FIRST: TAKE GROUPS OF GALAXIES (SINGLE GALAXIES
+    # BY DEFAULT) IN ORDER OF DECREASING COST AND GIVE EACH ONE TO THE LEAST
+    # LOADED WORKER, SO EVERY WORKER RUNS ITS WORK LONGEST FIRST. GALAXIES
+    # THAT WOULD NOT FIT IN MEM_BUDGET BYTES ARE NOT ASSIGNED AND ARE
+    # RETURNED SEPARATELY. WITH FIELDS EVERY GROUP IS ALSO MOSAICKED AS ONE
+    # FIELD, SO A GROUP WHOSE FIELD WOULD NOT FIT IS PACKED GALAXY BY GALAXY.
+    if groups is None:
+        groups = [[i] for i in range(len(plan))]
+    if fields and mem_budget is not None:
+        fit = []
+        for group in groups:
+            if len(group) > 1 and field_memory(plan, group, pix_scale_deg) > mem_budget:
+                fit.extend([i] for i in group)
+            else:
+                fit.append(group)
+        groups = fit
+    too_big = []
+    packed = []
+    for group in groups:
+        keep = []
+        for i in group:
+            if mem_budget is not None and plan[i]['memory'] > mem_budget:
+                too_big.append(i)
+            else:
+                keep.append(i)
+        if len(keep) > 0:
+            keep.sort(key=lambda i: -plan[i]['cost'])
+            packed.append((sum(plan[i]['cost'] for i in keep), keep))
+    packed.sort(key=lambda g: -g[0])
+
+    jobs = [[] for i in range(nworkers)]
+    heap = [(0., w) for w in range(nworkers)]
+    for cost, group in packed:
+        load, w = heapq.heappop(heap)
+        jobs[w].extend(group)
+        heapq.heappush(heap, (load + cost, w))
+    return jobs, sorted(too_big)
+
+
+def tile_clusters(plan, min_overlap=0.3, max_size_deg=None):
+    # GROUP GALAXIES WHOSE TILE SETS OVERLAP. TWO GALAXIES ARE LINKED WHEN THE
+    # JACCARD INDEX OF THEIR TILE SETS IS AT LEAST MIN_OVERLAP; CLUSTERS ARE
+    # THE CONNECTED COMPONENTS (UNION-FIND). ONLY PAIRS THAT SHARE A TILE ARE
+    # EVER COMPARED. CLUSTERS WIDER THAN MAX_SIZE_DEG ARE SPLIT (SEE
+    # split_cluster), SO A CHAIN OF OVERLAPPING GALAXIES NEVER MAKES ONE
+    # ENORMOUS FIELD.
+    parent = list(range(len(plan)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    by_tile = {}
+    for i, p in enumerate(plan):
+        for t in p['tiles']:
+            by_tile.setdefault(t, []).append(i)
+
+    checked = set()
+    for members in by_tile.values():
+        for a in range(len(members)):
+            for b in range(a + 1, len(members)):
+                i, j = members[a], members[b]
+                if (i, j) in checked:
+                    continue
+                checked.add((i, j))
+                ti, tj = plan[i]['tiles'], plan[j]['tiles']
+                if len(ti & tj) >= min_overlap * len(ti | tj):
+                    parent[find(i)] = find(j)
+
+    clusters = {}
+    for i in range(len(plan)):
+        clusters.setdefault(find(i), []).append(i)
+    clusters = list(clusters.values())
+    if max_size_deg is not None:
+        clusters = [part for members in clusters for part in split_cluster(plan, members, max_size_deg)]
+    return sorted(clusters, key=lambda c: c[0])
+
+
+def split_cluster(plan, members, max_size_deg):
+    # CUT A CLUSTER IN HALF ACROSS ITS LONGER SIDE UNTIL EVERY PART'S FIELD
+    # (SEE field_extent) IS AT MOST MAX_SIZE_DEG. SINGLE GALAXIES ARE KEPT
+    # WHATEVER THEIR SIZE.
+    if len(members) < 2:
+        return [members]
+    ra_ctr, dec_ctr, size_deg = field_extent(plan, members)
+    if size_deg <= max_size_deg:
+        return [members]
+    x = dict((i, ((plan[i]['ra'] - ra_ctr + 180.) % 360. - 180.) * np.cos(np.radians(dec_ctr))) for i in members)
+    y = dict((i, plan[i]['dec'] - dec_ctr) for i in members)
+    axis = x if np.ptp(list(x.values())) >= np.ptp(list(y.values())) else y
+    members = sorted(members, key=lambda i: axis[i])
+    half = len(members) // 2
+    parts = split_cluster(plan, members[:half], max_size_deg) + split_cluster(plan, members[half:], max_size_deg)
+    return [sorted(part) for part in parts]
+
+
+def field_extent(plan, members):
+    # CENTER AND SIDE (DEGREES) OF A SQUARE FIELD COVERING EVERY CUTOUT IN A
+    # CLUSTER. THE CENTER IS THE MEAN DIRECTION, SO FIELDS MAY CROSS RA = 0.
+    ra = np.radians([plan[i]['ra'] for i in members])
+    dec = np.radians([plan[i]['dec'] for i in members])
+    vec = np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)]).sum(axis=1)
+    ra_ctr = np.degrees(np.arctan2(vec[1], vec[0])) % 360.
+    dec_ctr = np.degrees(np.arcsin(vec[2] / np.sqrt(np.sum(vec**2))))
+
+    cos_sep = (np.sin(dec) * np.sin(np.radians(dec_ctr)) +
+               np.cos(dec) * np.cos(np.radians(dec_ctr)) * np.cos(ra - np.radians(ra_ctr)))
+    sep = np.degrees(np.arccos(np.clip(cos_sep, -1., 1.)))
+    half = [sep[k] + np.sqrt(2.) * plan[i]['size_deg'] / 2. for k, i in enumerate(members)]
+    return ra_ctr, dec_ctr, 2. * max(half)
+
+
+def field_memory(plan, members, pix_scale_deg=1.5/3600.):
+    # PEAK BYTES OF A MOSAIC COVERING THE WHOLE CLUSTER
+    size_deg = field_extent(plan, members)[2]
+    return (size_deg / pix_scale_deg)**2 * _BYTES_PER_PIX
+
+
+def max_field_deg(mem_budget, pix_scale_deg=1.5/3600.):
+    # SIDE OF THE LARGEST FIELD MOSAIC THAT FITS IN MEM_BUDGET BYTES
+    return np.sqrt(mem_budget / _BYTES_PER_PIX) * pix_scale_deg
+
+
+def cluster_header(plan, members, pix_scale_deg=1.5/3600.):
+    # A TARGET HEADER COVERING EVERY CUTOUT IN A CLUSTER. TILES ARE CUT TO THIS
+    # HEADER ONCE AND THEN SHARED BY ALL OF THE CLUSTER'S GALAXIES.
+    ra_ctr, dec_ctr, size_deg = field_extent(plan, members)
+    return extract_stamp.target_header(ra_ctr, dec_ctr, size_deg / pix_scale_deg, pix_scale_deg)[0]
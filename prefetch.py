@@ -0,0 +1,116 @@
+import os
+import shutil
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class TilePrefetcher(object):
+    # COPY ARCHIVE TILES INTO NODE-LOCAL SCRATCH (A LOCAL DISK OR /dev/shm)
+    # WITH A POOL OF THREADS WHILE THE CURRENT GALAXY IS BEING PROCESSED.
+    # EACH FILE IS REFERENCE COUNTED BY THE GALAXIES THAT NEED IT AND IS
+    # REMOVED FROM SCRATCH ONCE THE LAST OF THEM HAS BEEN RELEASED. HOW FAR
+    # AHEAD IT READS IS BOUNDED BY HOW MANY GALAXIES THE CALLER SCHEDULES
+    # (make_cutouts --prefetch), NOT BY THE QUEUE, SO SCHEDULING NEVER WAITS.
+
+    def __init__(self, scratch_dir, nthreads=4):
+        self.scratch_dir = scratch_dir
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._done = {}
+        self._failed = set()
+        self._refs = {}
+        self._keys = {}
+        self._threads = []
+        for i in range(nthreads):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _local_name(self, path):
+        # MIRROR THE ARCHIVE PATH SO TILES FROM DIFFERENT DIRECTORIES DO NOT COLLIDE
+        return os.path.join(self.scratch_dir, os.path.abspath(path).lstrip(os.sep))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            path, event = item
+            local = self._local_name(path)
+            try:
+                if not os.path.exists(local):
+                    local_dir = os.path.dirname(local)
+                    if not os.path.exists(local_dir):
+                        try:
+                            os.makedirs(local_dir)
+                        except OSError:
+                            pass
+                    tmp = local + '.part'
+                    shutil.copyfile(os.path.realpath(path), tmp)
+                    os.rename(tmp, local)
+            except (IOError, OSError):
+                self._failed.add(path)
+            finally:
+                event.set()
+                self._queue.task_done()
+
+    def schedule(self, key, files):
+        # REGISTER THE FILES NEEDED BY ONE GALAXY AND QUEUE THE ONES NOT YET
+        # FETCHED. NEVER BLOCKS.
+        todo = []
+        with self._lock:
+            self._keys[key] = list(files)
+            for f in files:
+                self._refs[f] = self._refs.get(f, 0) + 1
+                if f not in self._done:
+                    self._done[f] = threading.Event()
+                    todo.append((f, self._done[f]))
+        for item in todo:
+            self._queue.put_nowait(item)
+
+    def local_path(self, path):
+        # WAIT FOR A SCHEDULED FILE AND RETURN ITS LOCAL COPY. UNSCHEDULED OR
+        # FAILED FILES ARE READ FROM THE ARCHIVE AS BEFORE.
+        event = self._done.get(path)
+        if event is None:
+            return path
+        event.wait()
+        if path in self._failed:
+            return path
+        return self._local_name(path)
+
+    def release(self, key):
+        # EVICT THE LOCAL COPIES THAT NO REMAINING GALAXY NEEDS. COPIES STILL
+        # IN FLIGHT ARE WAITED FOR WITHOUT HOLDING THE LOCK.
+        unused = []
+        with self._lock:
+            for f in self._keys.pop(key, []):
+                self._refs[f] -= 1
+                if self._refs[f] > 0:
+                    continue
+                del self._refs[f]
+                unused.append((f, self._done.pop(f)))
+        for f, event in unused:
+            event.wait()
+        with self._lock:
+            for f, event in unused:
+                # A LATER GALAXY MAY HAVE SCHEDULED THE FILE AGAIN MEANWHILE
+                if f in self._refs:
+                    continue
+                self._failed.discard(f)
+                local = self._local_name(f)
+                if os.path.exists(local):
+                    os.remove(local)
+
+    def close(self):
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        for key in list(self._keys):
+            self.release(key)
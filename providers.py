@@ -0,0 +1,153 @@
+import os
+import threading
+import warnings
+import manifest
+import download
+
+
+# TILE PROVIDERS FOR surveys.mosaic. BOTH MAP AN ARCHIVE PATH (data_dir + INDEX
+# FNAME) TO A FILE THAT EXISTS ON THIS NODE:
+#
+#   fetch(files, optional)  MAKE A BATCH OF TILES AVAILABLE AND RETURN THE
+#                           FILES THAT CANNOT BE, WITH A WARNING. THE CALLER
+#                           DROPS THOSE TILES, AS THE ORIGINAL PIPELINE DID
+#                           FOR TILES WITHOUT AN RRHR FILE. OPTIONAL FILES
+#                           ARE MADE AVAILABLE WHEN POSSIBLE AND OTHERWISE
+#                           LEFT OUT.
+#   local_path(path)        WHERE TO READ ONE TILE FROM
+#
+# THE IMAGE AND EXPOSURE (RRHR) TILES ARE REQUIRED. FLAG MAPS AND SKY
+# BACKGROUND MAPS ARE OPTIONAL: A TILE WITHOUT FLAGS IS MASKED BY ITS CHIP
+# GEOMETRY ALONE, AND ONE WITHOUT A SKY MAP IS TREATED AS NOT SKY-MATCHED
+# (SEE extract_stamp.sky_matched), SO THE BACKGROUND IS STILL MODELLED.
+
+
+class LocalArchive(object):
+    # THE WHOLE ARCHIVE IS MOUNTED ON THIS NODE. MISSING TILES ARE REPORTED
+    # UP FRONT INSTEAD OF SURFACING AS A MONTAGE FAILURE LATER.
+
+    def fetch(self, files, optional=()):
+        missing = [f for f in files if not os.path.exists(f)]
+        if len(missing) > 0:
+            warnings.warn(str(len(missing)) + ' tiles missing from the archive, e.g. ' + missing[0])
+        return missing
+
+    def local_path(self, path):
+        if not os.path.exists(path):
+            raise IOError('Tile missing from the archive: ' + path)
+        return path
+
+
+class FetchOnMiss(object):
+    # USE THE ARCHIVE COPY OF A TILE WHEN THIS NODE HAS ONE, OTHERWISE
+    # DOWNLOAD IT INTO A LOCAL CACHE. URLS COME FROM THE ALL-SKY TABLE (SEE
+    # manifest.read_table). THE CACHE IS KEPT UNDER MAX_BYTES BY REMOVING THE
+    # LEAST RECENTLY USED TILES, NEVER ONES FROM THE CURRENT BATCH. THE CACHE
+    # SIZE IS COUNTED ONCE AND THEN KEPT UP TO DATE AS TILES ARRIVE, SO ONLY
+    # A DOWNLOAD THAT TAKES IT OVER MAX_BYTES WALKS THE CACHE.
+
+    def __init__(self, data_dir, cache_dir, table, max_bytes=500 * 1024**3, base_url=None, nthreads=8):
+        self.data_dir = data_dir
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._nbytes = None
+        self._downloader = download.TileDownloader(cache_dir, nthreads=nthreads, base_url=base_url)
+
+        # ONE URL PER TILE; OTHER PRODUCTS ARE DERIVED BY SWAPPING THE SUFFIX
+        tiles = manifest.unique_tiles(table)
+        urls = manifest.manifest_urls(tiles['line'])
+        self._urls = dict(zip(tiles['base'], zip(urls, tiles['product'])))
+
+    def _relpath(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.data_dir))
+
+    def _cache_path(self, path):
+        return os.path.join(self.cache_dir, self._relpath(path))
+
+    def url(self, path):
+        base, product = manifest.split_names([path])
+        base, product = str(base[0]), str(product[0])
+        if base not in self._urls:
+            return None
+        url, old = self._urls[base]
+        return url.replace('-' + old + '.', '-' + product + '.')
+
+    def fetch(self, files, optional=()):
+        need = [f for f in list(files) + list(optional) if not os.path.exists(f) and not os.path.exists(self._cache_path(f))]
+        required = set(files)
+        urls, unknown, failed = {}, [], []
+        for f in need:
+            url = self.url(f)
+            if url is None:
+                if f in required:
+                    unknown.append(f)
+            else:
+                urls[url] = f
+                self._downloader.layout[os.path.basename(self._relpath(f))] = self._relpath(f)
+        if len(urls) > 0:
+            with self._lock:
+                counts, failed = self._downloader.download(list(urls))
+                self._add_bytes([urls[url] for url in urls if url not in failed])
+            failed = [urls[url] for url in failed if urls[url] in required]
+            if len(failed) > 0:
+                warnings.warn(str(len(failed)) + ' tiles could not be fetched, e.g. ' + failed[0])
+        if len(unknown) > 0:
+            warnings.warn(str(len(unknown)) + ' tiles have no download URL, e.g. ' + unknown[0])
+
+        keep = []
+        for f in list(files) + list(optional):
+            local = self._cache_path(f)
+            if not os.path.exists(f) and os.path.exists(local):
+                os.utime(local, None)
+                keep.append(local)
+        if len(urls) > 0 and self._nbytes > self.max_bytes:
+            with self._lock:
+                self.evict(keep=keep)
+        return failed + unknown
+
+    def _add_bytes(self, fetched):
+        # COUNT THE CACHE ONCE, THEN ADD EACH NEW DOWNLOAD
+        if self._nbytes is None:
+            self._nbytes = sum(c[1] for c in self._cached())
+            return
+        for f in fetched:
+            local = self._cache_path(f)
+            if os.path.exists(local):
+                self._nbytes += os.path.getsize(local)
+
+    def local_path(self, path):
+        if os.path.exists(path):
+            return path
+        local = self._cache_path(path)
+        if not os.path.exists(local) and len(self.fetch([path])) > 0:
+            raise IOError('Tile could not be fetched: ' + path)
+        return local
+
+    def _cached(self):
+        cached = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                if f.endswith('.part') or f.endswith('.tmp'):
+                    continue
+                st = os.stat(path)
+                cached.append((st.st_mtime, st.st_size, path))
+        return cached
+
+    def evict(self, keep=()):
+        # REMOVE THE LEAST RECENTLY USED TILES UNTIL THE CACHE FITS
+        keep = set(os.path.abspath(f) for f in keep)
+        cached = self._cached()
+        total = sum(c[1] for c in cached)
+        removed = 0
+        for mtime, size, path in sorted(cached):
+            if total <= self.max_bytes:
+                break
+            if os.path.abspath(path) in keep:
+                continue
+            os.remove(path)
+            total -= size
+            removed += 1
+        self._nbytes = total
+        return removed
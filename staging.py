@@ -0,0 +1,109 @@
+import os
+import shutil
+import hashlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# LINUX ioctl THAT SHARES EXTENTS BETWEEN TWO FILES (BTRFS, XFS, ...)
+_FICLONE = 0x40049409
+
+
+def file_hash(path, blocksize=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            h.update(block)
+            block = f.read(blocksize)
+    return h.hexdigest()
+
+
+def same_content(src, dst):
+    # CHEAP SIZE CHECK FIRST, THEN HASH BOTH FILES
+    if not os.path.exists(dst):
+        return False
+    if os.path.getsize(src) != os.path.getsize(dst):
+        return False
+    if os.path.samefile(src, dst):
+        return True
+    return file_hash(src) == file_hash(dst)
+
+
+def same_filesystem(src, dst_dir):
+    return os.stat(src).st_dev == os.stat(dst_dir).st_dev
+
+
+def reflink(src, dst):
+    if fcntl is None:
+        return False
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        return True
+    except (IOError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+
+def stage_file(src, dst, move=False):
+    # PUT SRC AT DST WITHOUT EVER EXPOSING A PARTIAL FILE. SKIPS FILES WHOSE
+    # CONTENT IS ALREADY THERE, RENAMES OR SHARES BLOCKS WHEN SOURCE AND
+    # DESTINATION ARE ON ONE FILESYSTEM AND ONLY COPIES BYTES OTHERWISE.
+    dst_dir = os.path.dirname(os.path.abspath(dst))
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+
+    if same_content(src, dst):
+        if move and not os.path.samefile(src, dst):
+            os.remove(src)
+        return 'skipped'
+
+    if same_filesystem(src, dst_dir):
+        if move:
+            os.rename(src, dst)
+            return 'renamed'
+        tmp = dst + '.tmp' + str(os.getpid())
+        if reflink(src, tmp):
+            action = 'reflinked'
+        else:
+            try:
+                os.link(src, tmp)
+                action = 'linked'
+            except OSError:
+                shutil.copyfile(src, tmp)
+                action = 'copied'
+    else:
+        tmp = dst + '.tmp' + str(os.getpid())
+        shutil.copyfile(src, tmp)
+        action = 'copied'
+
+    os.rename(tmp, dst)
+    if move:
+        os.remove(src)
+    return action
+
+
+def stage_products(pairs, move=False):
+    # STAGE A BATCH OF (SRC, DST) PAIRS, E.G. THE PRODUCTS OF MANY GALAXIES.
+    # RETURNS HOW MANY FILES WERE HANDLED EACH WAY.
+    counts = {}
+    for src, dst in pairs:
+        action = stage_file(src, dst, move=move)
+        counts[action] = counts.get(action, 0) + 1
+    return counts
+
+
+def stage_tree(src_dir, dst_dir, move=False, suffixes=('.FITS', '.fits')):
+    # STAGE EVERY PRODUCT UNDER SRC_DIR INTO THE SAME LAYOUT UNDER DST_DIR
+    pairs = []
+    for root, dirs, files in os.walk(src_dir):
+        for f in sorted(files):
+            if f.endswith(tuple(suffixes)):
+                src = os.path.join(root, f)
+                pairs.append((src, os.path.join(dst_dir, os.path.relpath(src, src_dir))))
+    return stage_products(pairs, move=move)
@@ -0,0 +1,457 @@
+import astropy.io.fits as pyfits
+import os
+import re
+import sys
+import glob
+import time
+import shutil
+import numpy as np
+import extract_stamp
+
+
+# SURVEY BACKENDS. A BACKEND DESCRIBES ONE SURVEY AND mosaic() RUNS THE SAME
+# PIPELINE FOR ALL OF THEM, SO ANY SPEEDUP OF A STAGE APPLIES TO EVERY SURVEY:
+#
+#   read_index()                          THE TILE INDEX
+#   tiles(index, band, ra, dec, size, hdr) INDEX ROWS OF THE TILES NEAR THE TARGET
+#   tile_files(index, ind, band, product) ARCHIVE PATHS: (IMAGES, WEIGHTS OR None, EXTRA FILES PER TILE)
+#   to_mjysr(band)                        FACTOR FROM ARCHIVE UNITS TO MJY/SR
+#   section_align(hdr, extra)             PIXEL ALIGNMENT OF THE TILE SECTIONS
+#   mask(im, wt, hdr, section, extra)     BLANK BAD PIXELS, RETURNING (IM, WT)
+#   annotate(hdr, infile, extra, band, product)  EXTRA PER-TILE HEADER KEYWORDS
+#
+# THE PRODUCT IS THE KIND OF TILE READ: 'int' INTENSITY MAPS (EVERY SURVEY)
+# AND, FOR GALEX, 'intbgsub' SKY-SUBTRACTED MAPS OR 'cnt' COUNT MAPS THAT ARE
+# COADDED RAW AND DIVIDED BY THE COADDED EXPOSURE AT THE END.
+#   native_pix_as(band), pix_scale(band)  DETECTOR PIXEL (ARCSEC) AND OUTPUT PIXEL (DEG)
+
+
+class Survey(object):
+    tel = None
+    bands = ()
+    weighted = False          # TILES COME WITH WEIGHT (EXPOSURE) MAPS...
+    weight_suffix = None      # ...NAMED LIKE THIS
+    subtract_mean = False     # REMOVE THE MEAN OF EACH WHOLE TILE
+    check_footprints = False  # ALSO TEST REAL TILE EDGES, ONCE THE TILE IS LOCAL
+    bg_reg_file = None        # PIXEL REGION FILE FOR THE FINAL BACKGROUND
+    products = ('int',)       # TILE PRODUCTS THE ARCHIVE HAS
+
+    def bandname(self, band):
+        return str(band).lower()
+
+    def data_dir(self):
+        return os.path.join(extract_stamp._TOP_DIR, self.tel, 'sorted_tiles')
+
+    def read_index(self):
+        return extract_stamp.read_index(self.tel)
+
+    def band_rows(self, index, band):
+        return np.ones(len(index), dtype=bool)
+
+    def tiles(self, index, band, ra_ctr, dec_ctr, size_deg, target_hdr=None):
+        tile_overlaps = extract_stamp.calc_tile_overlap(ra_ctr, dec_ctr, pad=size_deg,
+                                                        min_ra=index['MIN_RA'],
+                                                        max_ra=index['MAX_RA'],
+                                                        min_dec=index['MIN_DEC'],
+                                                        max_dec=index['MAX_DEC'])
+        return np.where(self.band_rows(index, band) & tile_overlaps)
+
+    def tile_files(self, index, ind, band, product='int'):
+        infiles = [os.path.join(self.data_dir(), f) for f in index[ind[0]]['FNAME']]
+        return infiles, None, [[] for f in infiles]
+
+    def to_mjysr(self, band):
+        return 1.0
+
+    def section_align(self, hdr, extra):
+        return 1
+
+    def mask(self, im, wt, hdr, section, extra):
+        return im, wt
+
+    def annotate(self, hdr, infile, extra, band, product):
+        return hdr
+
+    def native_pix_as(self, band):
+        raise NotImplementedError
+
+    def pix_scale(self, band):
+        return self.native_pix_as(band) / 3600.
+
+
+class Galex(Survey):
+    tel = 'galex'
+    bands = ('fuv', 'nuv')
+    weighted = True
+    weight_suffix = '-rrhr.fits'
+    subtract_mean = True
+    products = ('int', 'intbgsub', 'cnt')
+
+    def __init__(self):
+        self.bg_reg_file = os.path.join(extract_stamp._HOME_DIR, 'galex_reprojected_bg.reg')
+
+    def tiles(self, index, band, ra_ctr, dec_ctr, size_deg, target_hdr=None):
+        return extract_stamp.galex_tiles(index, band, ra_ctr, dec_ctr, size_deg)
+
+    def tile_files(self, index, ind, band, product='int'):
+        # EXTRA FILES: THE FLAG MAP AND, FOR SKY-SUBTRACTED TILES, THE SKY MAP
+        infiles, wtfiles, flgfiles = extract_stamp.galex_tile_files(index, ind, self.data_dir(), product=product)
+        if product == 'intbgsub':
+            skyfiles = [f.replace('-intbgsub.fits', '-skybg.fits') for f in infiles]
+            return infiles, wtfiles, [[f, g] for f, g in zip(flgfiles, skyfiles)]
+        return infiles, wtfiles, [[f] for f in flgfiles]
+
+    def to_mjysr(self, band):
+        # counts2jy_galex IS LINEAR IN THE COUNTS
+        return extract_stamp.counts2jy_galex(1.0, extract_stamp._GALEX_TOAB[band.lower()], extract_stamp._GALEX_PIX_AS)
+
+    def section_align(self, hdr, extra):
+        # KEEP SECTIONS ON WHOLE FLAG PIXELS
+        if len(extra) == 0 or not os.path.exists(extra[0]):
+            return 1
+        return extract_stamp.flag_factor(hdr, pyfits.getheader(extra[0]))
+
+    def mask(self, im, wt, hdr, section, extra):
+        flag = fhdr = None
+        if len(extra) > 0 and os.path.exists(extra[0]):
+            fhdr = pyfits.getheader(extra[0])
+            factor = extract_stamp.flag_factor(hdr, fhdr)
+            flag_section = None
+            if section is not None:
+                flag_section = tuple(-(-n // factor) for n in section)
+            flag, fhdr = extract_stamp.read_section(extra[0], flag_section)
+        return extract_stamp.galex_chip_mask(im, wt, hdr, flag=flag, fhdr=fhdr)
+
+    def annotate(self, hdr, infile, extra, band, product):
+        # SKY-SUBTRACTED TILES CARRY THEIR ARCHIVE SKY STATISTICS IN MJY/SR,
+        # OR SKYSTAT = F WITHOUT A SKY MAP (SEE extract_stamp.sky_matched)
+        if product == 'intbgsub':
+            stats = extract_stamp.tile_sky_stats(extra[1], infile)
+            hdr['SKYSTAT'] = stats is not None
+            if stats is not None:
+                hdr['SKYLEVEL'] = stats[0] * self.to_mjysr(band)
+                hdr['SKYRESID'] = stats[1] * self.to_mjysr(band)
+        return hdr
+
+    def native_pix_as(self, band):
+        return extract_stamp._GALEX_PIX_AS
+
+
+class Unwise(Survey):
+    tel = 'unwise'
+    bands = (1, 2, 3, 4)
+    check_footprints = True
+
+    def bandname(self, band):
+        return 'w' + str(band)
+
+    def band_rows(self, index, band):
+        #  index file set up such that index['BAND'] = 1, 2, 3, 4 depending on wise band
+        return index['BAND'] == band
+
+    def to_mjysr(self, band):
+        return extract_stamp.UNWISE_TO_MJYSR[band]
+
+    def native_pix_as(self, band):
+        return extract_stamp._UNWISE_PIX_AS
+
+    def pix_scale(self, band):
+        return 2.0 / 3600.  # 2.0 arbitrary
+
+
+# SINGS MIPS PIXEL SIZES IN ARCSECONDS, PER WAVELENGTH
+_MIPS_PIX_AS = {24: 1.5, 70: 4.5, 160: 9.0}
+
+# MIPS INDEX BUILT FROM THE MAP HEADERS, KEYED BY DIRECTORY
+_MIPS_INDEX_CACHE = {}
+
+
+class Mips(Survey):
+    # SINGS MIPS MAPS: ONE MAP PER GALAXY AND WAVELENGTH, ALREADY IN MJY/SR.
+    # THERE IS NO INDEX FILE, SO ONE IS BUILT FROM THE MAP HEADERS.
+    tel = 'mips'
+    bands = (24, 70, 160)
+    check_footprints = True
+
+    def __init__(self, mips_dir):
+        self.mips_dir = mips_dir
+
+    def bandname(self, band):
+        return 'mips' + str(band)
+
+    def data_dir(self):
+        return self.mips_dir
+
+    def read_index(self):
+        key = os.path.abspath(self.mips_dir)
+        if key not in _MIPS_INDEX_CACHE:
+            rows = []
+            for f in sorted(glob.glob(os.path.join(self.mips_dir, '*.fits'))):
+                base = os.path.basename(f).lower().replace('_', '')
+                match = re.search(r'mips(160|70|24)', base)
+                if match is None:
+                    continue
+                ra, dec = extract_stamp.image_footprint(pyfits.getheader(f))
+                ra = np.mod(ra, 360.)
+                min_ra, max_ra = ra.min(), ra.max()
+                if max_ra - min_ra > 180.:
+                    # CROSSES RA = 0: STORE AS A MERIDIAN TILE (MAX < MIN)
+                    min_ra, max_ra = ra[ra > 180.].min(), ra[ra < 180.].max()
+                rows.append((os.path.basename(f), int(match.group(1)), min_ra, max_ra, dec.min(), dec.max()))
+            dtype = [('FNAME', 'U256'), ('BAND', 'i4'), ('MIN_RA', 'f8'), ('MAX_RA', 'f8'), ('MIN_DEC', 'f8'), ('MAX_DEC', 'f8')]
+            _MIPS_INDEX_CACHE[key] = np.rec.fromrecords(rows, dtype=dtype)
+        return _MIPS_INDEX_CACHE[key]
+
+    def band_rows(self, index, band):
+        return index['BAND'] == int(band)
+
+    def native_pix_as(self, band):
+        return _MIPS_PIX_AS[int(band)]
+
+
+GALEX = Galex()
+UNWISE = Unwise()
+
+
+def prepare_tiles(survey, band, infiles, wtfiles, extras, target_hdr, im_dir, wt_dir=None, product='int'):
+    # CUT, CALIBRATE AND MASK EVERY TILE IN ONE PASS: EACH TILE SECTION IS
+    # READ ONCE AND WRITTEN ONCE, READY FOR REPROJECTION. COUNT MAPS ARE
+    # ONLY CUT AND MASKED; THEY ARE CALIBRATED AFTER COADDITION.
+    to_mjysr = survey.to_mjysr(band)
+    nfiles = 0
+    for i in range(len(infiles)):
+        if wtfiles is not None and not os.path.exists(wtfiles[i]):
+            continue
+        hdr = pyfits.getheader(infiles[i])
+        if survey.check_footprints and not extract_stamp.footprints_overlap(hdr, target_hdr):
+            continue
+        section = extract_stamp.tile_section(hdr, target_hdr, align=survey.section_align(hdr, extras[i]))
+        if section is None:
+            continue
+
+        im, hdr = extract_stamp.read_section(infiles[i], section)
+        wt = whdr = None
+        if wtfiles is not None:
+            wt, whdr = extract_stamp.read_section(wtfiles[i], section)
+
+        if product != 'cnt':
+            im = im * to_mjysr
+            hdr['BUNIT'] = 'MJY/SR'
+        if survey.subtract_mean and product == 'int':
+            im -= extract_stamp.tile_mean(infiles[i]) * to_mjysr
+        im, wt = survey.mask(im, wt, hdr, section, extras[i])
+        hdr = survey.annotate(hdr, infiles[i], extras[i], band, product)
+
+        # THE WEIGHT GOES FIRST, SO A CACHED IMAGE ALWAYS HAS ITS WEIGHT
+        if wtfiles is not None:
+            pyfits.writeto(os.path.join(wt_dir, os.path.basename(wtfiles[i])), wt, whdr, overwrite=True)
+        pyfits.writeto(os.path.join(im_dir, extract_stamp.converted_name(infiles[i], product)), im, hdr)
+        nfiles += 1
+    return nfiles
+
+
+def mosaic(survey, band, ra_ctr, dec_ctr, size_deg, name, index=None, write_info=True, model_bg=False, prefetcher=None, provider=None,
+           out_dir=None, out_format='fits', float32=False, pyramid=0, bg_method='mean', bg_annulus=None, tile_cache=None,
+           coadd_mode='int', input_mode='int', sky_tol=0.05, subtract_bg=True):
+    # ONE CUTOUT OF ONE BAND OF ANY SURVEY. COADD_MODE 'cnt' COADDS THE COUNT
+    # MAPS AND DIVIDES BY THE COADDED EXPOSURE; INPUT_MODE PICKS THE
+    # INTENSITY PRODUCT OTHERWISE. WITH A TILE CACHE ({'dir', 'hdr'}) TILES
+    # ARE CUT TO THE CLUSTER HEADER ONCE AND REUSED BY EVERY GALAXY OF THE
+    # CLUSTER. FIELD MOSAICS SKIP THE BACKGROUND (SUBTRACT_BG=False) AND
+    # LEAVE IT TO EACH CUTOUT (SEE extract_stamp.extract_cutout).
+    product = 'cnt' if coadd_mode == 'cnt' else input_mode
+    if product not in survey.products or (product == 'cnt' and not survey.weighted):
+        raise ValueError('No ' + product + ' tiles for ' + survey.tel)
+    problem_file = os.path.join(extract_stamp._HOME_DIR, 'problem_galaxies.txt')
+    numbers_file = os.path.join(extract_stamp._HOME_DIR, 'gal_reproj_info.dat')
+    if out_dir is None:
+        out_dir = extract_stamp._MOSAIC_DIR
+    bandname = survey.bandname(band)
+    prefix = '_'.join([name, bandname]).upper()
+
+    galaxy_mosaic_file = os.path.join(out_dir, prefix + '.FITS')
+
+    start_time = time.time()
+    if os.path.exists(galaxy_mosaic_file):
+        return
+
+    # READ THE INDEX FILE (IF NOT PASSED IN)
+    if index is None:
+        index = survey.read_index()
+
+    # MAKE A HEADER
+    pix_scale = survey.pix_scale(band)
+    pix_len = size_deg / pix_scale
+    target_hdr, hdr_template = extract_stamp.target_header(ra_ctr, dec_ctr, pix_len, pix_scale)
+
+    # FIND OVERLAPPING TILES WITH RIGHT BAND
+    ind = survey.tiles(index, band, ra_ctr, dec_ctr, size_deg, target_hdr)
+
+    # MAKE SURE THERE ARE OVERLAPPING TILES
+    if len(ind[0]) == 0:
+        with open(problem_file, 'a') as myfile:
+            myfile.write(name + ': ' + 'No overlapping ' + bandname.upper() + ' tiles\n')
+        return
+
+    gal_dir = os.path.join(extract_stamp._HOME_DIR, prefix)
+    try:
+        # CREATE NEW TEMP DIRECTORY TO STORE TEMPORARY FILES
+        os.makedirs(gal_dir)
+
+
+        # WHERE THE CUT TILES GO: THIS GALAXY'S TEMP DIR, OR THE CLUSTER CACHE
+        im_dir = os.path.join(gal_dir, 'converted', 'int')
+        wt_dir = os.path.join(gal_dir, 'converted', 'rrhr')
+        cut_im_dir, cut_wt_dir, cut_hdr = im_dir, wt_dir, target_hdr
+        if tile_cache is not None:
+            cache_dir = os.path.join(tile_cache['dir'], bandname + '_' + product)
+            cut_im_dir, cut_wt_dir = os.path.join(cache_dir, 'int'), os.path.join(cache_dir, 'rrhr')
+            cut_hdr = tile_cache['hdr']
+        for d in [im_dir, cut_im_dir] + ([wt_dir, cut_wt_dir] if survey.weighted else []):
+            if not os.path.exists(d):
+                os.makedirs(d)
+
+        infiles, wtfiles, extras = survey.tile_files(index, ind, band, product=product)
+        cut_files = [os.path.join(cut_im_dir, extract_stamp.converted_name(f, product)) for f in infiles]
+        todo = [i for i in range(len(infiles)) if not os.path.exists(cut_files[i])]
+
+
+        # MAKE SURE EVERY TILE STILL TO CUT IS AVAILABLE (FETCHING IT IF THE
+        # PROVIDER CAN). THE EXTRA FILES (FLAG AND SKY MAPS) ARE OPTIONAL (SEE
+        # providers). TILES WHOSE IMAGE OR WEIGHT IS MISSING ARE DROPPED; IF
+        # NONE IS LEFT THE TARGET IS REPORTED BELOW.
+        if provider is not None and len(todo) > 0:
+            missing = set(provider.fetch([infiles[i] for i in todo] + ([] if wtfiles is None else [wtfiles[i] for i in todo]),
+                                         optional=[f for i in todo for f in extras[i]]))
+            if len(missing) > 0:
+                todo = [i for i in todo if infiles[i] not in missing and (wtfiles is None or wtfiles[i] not in missing)]
+                with open(problem_file, 'a') as myfile:
+                    myfile.write(name + ': ' + str(len(missing)) + ' ' + bandname.upper() + ' tile files missing, skipped\n')
+        todo_in = [infiles[i] for i in todo]
+        todo_wt = None if wtfiles is None else [wtfiles[i] for i in todo]
+        todo_extras = [extras[i] for i in todo]
+
+        def local(files, optional=False):
+            return [extract_stamp.local_file(f, prefetcher=prefetcher, provider=provider, optional=optional) for f in files]
+        todo_in = local(todo_in)
+        if todo_wt is not None:
+            todo_wt = local(todo_wt)
+        todo_extras = [local(extra, optional=True) for extra in todo_extras]
+
+
+        # CUT, CONVERT TO MJY/SR AND MASK, THEN COLLECT THIS TARGET'S TILES
+        prepare_tiles(survey, band, todo_in, todo_wt, todo_extras, cut_hdr, cut_im_dir, cut_wt_dir, product=product)
+        nfiles = 0
+        for i in range(len(infiles)):
+            if not os.path.exists(cut_files[i]):
+                continue
+            if cut_im_dir != im_dir:
+                os.symlink(cut_files[i], os.path.join(im_dir, os.path.basename(cut_files[i])))
+                if survey.weighted:
+                    wt_base = os.path.basename(wtfiles[i])
+                    os.symlink(os.path.join(cut_wt_dir, wt_base), os.path.join(wt_dir, wt_base))
+            nfiles += 1
+        if nfiles == 0:
+            with open(problem_file, 'a') as myfile:
+                myfile.write(name + ': ' + 'No overlapping ' + bandname.upper() + ' tiles\n')
+            shutil.rmtree(gal_dir, ignore_errors=True)
+            return
+
+
+        # THE ARCHIVE SKY SUBTRACTION USUALLY LEAVES THE TILES MATCHED ALREADY
+        if model_bg and product == 'intbgsub' and extract_stamp.sky_matched(im_dir, tol=sky_tol):
+            model_bg = False
+
+
+        # WRITE OUT HEADER FILE
+        hdr_file = os.path.join(gal_dir, name + '_template.hdr')
+        extract_stamp.write_headerfile(hdr_file, target_hdr, template=hdr_template)
+
+
+        # REPROJECT IMAGES
+        reprojected_dir = os.path.join(gal_dir, 'reprojected')
+        os.makedirs(reprojected_dir)
+        im_dir = extract_stamp.reproject_images(hdr_file, im_dir, reprojected_dir, 'int')
+        if survey.weighted:
+            wt_dir = extract_stamp.reproject_images(hdr_file, wt_dir, reprojected_dir, 'rrhr')
+
+
+        # MODEL THE BACKGROUND IN THE IMAGE FILES? (NOT FOR RAW COUNTS)
+        if model_bg and product != 'cnt':
+            im_dir = extract_stamp.bg_model(gal_dir, im_dir, hdr_file)
+
+
+        final_dir = os.path.join(gal_dir, 'mosaic')
+        os.makedirs(final_dir)
+        weight_file = None
+        count_file = os.path.join(final_dir, 'count_mosaic.fits')
+        if product == 'cnt':
+            # COUNTS AND EXPOSURE ARE COADDED AS THEY ARE: NO PER-TILE
+            # CALIBRATION, WEIGHTING OR BACKGROUND MATCHING
+            extract_stamp.create_table(wt_dir, dir_type='weights')
+            extract_stamp.create_table(im_dir, dir_type='cnt')
+            extract_stamp.create_table(im_dir, dir_type='count')
+            extract_stamp.coadd(hdr_file, final_dir, wt_dir, output='weights')
+            extract_stamp.coadd(hdr_file, final_dir, im_dir, output='cnt')
+            extract_stamp.coadd(hdr_file, final_dir, im_dir, output='count', add_type='count')
+
+            # COUNT RATE IN MJY/SR
+            mosaic_file = extract_stamp.finish_rate(final_dir, survey.to_mjysr(band))
+            weight_file = os.path.join(final_dir, 'weights_mosaic.fits')
+
+        elif survey.weighted:
+
+            # WEIGHT IMAGES, COADD THEM WITH THE WEIGHTS AND DIVIDE THEM OUT
+            weight_dir = os.path.join(gal_dir, 'weight')
+            os.makedirs(weight_dir)
+            im_dir, wt_dir = extract_stamp.weight_images(im_dir, wt_dir, weight_dir, wt_suff='*' + survey.weight_suffix)
+            extract_stamp.create_table(wt_dir, dir_type='weights')
+            extract_stamp.create_table(im_dir, dir_type='int')
+            extract_stamp.create_table(im_dir, dir_type='count')
+            extract_stamp.coadd(hdr_file, final_dir, wt_dir, output='weights')
+            extract_stamp.coadd(hdr_file, final_dir, im_dir, output='int')
+            extract_stamp.coadd(hdr_file, final_dir, im_dir, output='count', add_type='count')
+            mosaic_file = extract_stamp.finish_weight(final_dir)
+            weight_file = os.path.join(final_dir, 'weights_mosaic.fits')
+        else:
+            # COADD THE REPROJECTED IMAGES
+            extract_stamp.create_table(im_dir, dir_type='int')
+            extract_stamp.create_table(im_dir, dir_type='count')
+            extract_stamp.coadd(hdr_file, final_dir, im_dir, output='int')
+            extract_stamp.coadd(hdr_file, final_dir, im_dir, output='count', add_type='count')
+            mosaic_file = os.path.join(final_dir, 'int_mosaic.fits')
+
+
+        # SUBTRACT OUT THE BACKGROUND
+        if subtract_bg and (survey.bg_reg_file is not None or bg_annulus is not None):
+            extract_stamp.remove_background(final_dir, mosaic_file, survey.bg_reg_file, method=bg_method, bg_annulus=bg_annulus)
+            mosaic_file = os.path.join(final_dir, 'final_mosaic.fits')
+
+
+        # BUILD A LOW RESOLUTION PYRAMID?
+        pyramid_file = None
+        if pyramid > 0:
+            pyramid_file = extract_stamp.build_pyramid(final_dir, mosaic_file, weight_file, count_file, pyramid)
+
+
+        # MOVE MOSAIC FILES TO CUTOUTS DIRECTORY
+        extract_stamp.write_products(name, bandname, mosaic_file, weight_file, count_file, out_dir, out_format=out_format, float32=float32, pyramid_file=pyramid_file)
+
+
+        # REMOVE GALAXY DIRECTORY AND EXTRA FILES
+        shutil.rmtree(gal_dir, ignore_errors=True)
+
+
+        # WRITE OUT THE NUMBER OF TILES THAT OVERLAP THE GIVEN GALAXY
+        if write_info:
+            total_time = (time.time() - start_time) / 60.
+            extract_stamp.write_runtime(numbers_file, survey.tel, name, nfiles, total_time, target_hdr['NAXIS1'] * target_hdr['NAXIS2'])
+
+    # SOMETHING WENT WRONG
+    except Exception as inst:
+        me = sys.exc_info()[0]
+        with open(problem_file, 'a') as myfile:
+            myfile.write(name + ': ' + str(me) + ': '+str(inst)+'\n')
+        shutil.rmtree(gal_dir, ignore_errors=True)
+
+    return
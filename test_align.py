@@ -0,0 +1,48 @@
+import astropy.io.fits as pyfits
+import os
+import numpy as np
+import pytest
+import align
+import extract_stamp
+
+
+def write_band(tmpdir, name, band, ra_ctr, dec_ctr, pix_len, pix_scale, out_format):
+    # A SMOOTH IMAGE WITH WEIGHT AND COUNT MAPS, WRITTEN AS A FINISHED PRODUCT
+    hdr = extract_stamp.target_header(ra_ctr, dec_ctr, pix_len, pix_scale)[0]
+    ny, nx = int(hdr['NAXIS2']), int(hdr['NAXIS1'])
+    yy, xx = np.mgrid[0:ny, 0:nx]
+    planes = []
+    for extname, data in [('image', 1. + 0.01 * xx + 0.02 * yy), ('weight', np.ones((ny, nx))), ('count', np.ones((ny, nx)))]:
+        f = str(tmpdir.join(band + '_' + extname + '.fits'))
+        pyfits.writeto(f, data, hdr)
+        planes.append(f)
+    out_dir = str(tmpdir.join('products'))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    extract_stamp.write_products(name, band, planes[0], planes[1], planes[2], out_dir, out_format=out_format)
+    return out_dir
+
+
+@pytest.mark.parametrize('out_format', ['fits', 'packed', 'compressed'])
+def test_align_galaxy_formats(tmpdir, out_format):
+    out_dir = write_band(tmpdir, 'NGC0001', 'fuv', 10., 5., 60, 1.5 / 3600., out_format)
+    write_band(tmpdir, 'NGC0001', 'w1', 10., 5., 45, 2. / 3600., out_format)
+
+    files = align.band_files(out_dir, 'NGC0001')
+    assert [band for band, f in files] == ['FUV', 'W1']
+    outfile = align.align_galaxy('NGC0001', files, str(tmpdir.join('aligned')), ref_band='FUV')
+
+    cube, hdr = pyfits.getdata(outfile, header=True)
+    assert cube.shape == (2, 60, 60)
+    assert hdr['REFBAND'] == 'FUV'
+    ref = align.read_image(files[0][1])[0]
+    assert np.allclose(cube[0], ref, rtol=1e-3)
+
+    assert len(align._MAP_CACHE) == 0
+
+    # THE SAME LINEAR RAMP RESAMPLED ONTO THE FUV GRID, AWAY FROM THE EDGES
+    w1_hdr = align.read_image(files[1][1])[1]
+    y, x = align.pixel_mapping(w1_hdr, align.read_image(files[0][1])[1])
+    inner = np.isfinite(cube[1])
+    assert inner.sum() > 0.5 * cube[1].size
+    assert np.allclose(cube[1][inner], (1. + 0.01 * x + 0.02 * y)[inner], rtol=1e-3)
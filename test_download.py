@@ -0,0 +1,167 @@
+import astropy.io.fits as pyfits
+import io
+import os
+import threading
+import numpy as np
+import pytest
+import download
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+
+class TileServer(ThreadingMixIn, HTTPServer):
+    # A LOCAL STAND-IN FOR THE TILE SERVER: SERVES FILES FROM MEMORY, HONOURS
+    # RANGE REQUESTS AND CAN DROP THE CONNECTION HALFWAY THROUGH A FILE
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), TileHandler)
+        self.files = {}
+        self.drop = set()
+        self.requests = []
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        byte_range = self.headers.get('Range')
+        self.server.requests.append((self.path, byte_range))
+        if self.path not in self.server.files:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        data = self.server.files[self.path]
+        start = 0
+        if byte_range is not None:
+            start = int(byte_range.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */' + str(len(data)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(len(data) - 1) + '/' + str(len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.path in self.server.drop:
+            self.server.drop.remove(self.path)
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+def fits_bytes(seed):
+    buf = io.BytesIO()
+    pyfits.PrimaryHDU(np.random.RandomState(seed).rand(60, 60)).writeto(buf)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def server():
+    srv = TileServer()
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def downloader(server, tmpdir, **kwargs):
+    base_url = 'http://127.0.0.1:' + str(server.server_address[1])
+    return download.TileDownloader(str(tmpdir), nthreads=2, base_url=base_url, retries=2, **kwargs)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_download_and_skip(server, tmpdir):
+    server.files['/tiles/a-int.fits'] = fits_bytes(0)
+    server.files['/tiles/b-int.fits'] = fits_bytes(1)
+    urls = ['http://archive.example/tiles/a-int.fits', 'http://archive.example/tiles/b-int.fits',
+            'http://archive.example/tiles/c-int.fits']
+    dl = downloader(server, tmpdir, layout={'a-int.fits': 'AIS_1/a-int.fits'})
+
+    counts, failed = dl.download(urls)
+    assert counts == {'downloaded': 2, 'failed': 1}
+    assert failed == [urls[2]]
+    assert read(str(tmpdir.join('AIS_1', 'a-int.fits'))) == server.files['/tiles/a-int.fits']
+    assert read(str(tmpdir.join('b-int.fits'))) == server.files['/tiles/b-int.fits']
+
+    counts, failed = dl.download(urls[:2])
+    assert counts == {'skipped': 2}
+
+
+def test_resume_part_file(server, tmpdir):
+    data = fits_bytes(2)
+    server.files['/tiles/a-int.fits'] = data
+    with open(str(tmpdir.join('a-int.fits.part')), 'wb') as f:
+        f.write(data[:5000])
+
+    counts, failed = downloader(server, tmpdir).download(['http://archive.example/tiles/a-int.fits'])
+    assert counts == {'downloaded': 1}
+    assert server.requests == [('/tiles/a-int.fits', 'bytes=5000-')]
+    assert read(str(tmpdir.join('a-int.fits'))) == data
+    assert not os.path.exists(str(tmpdir.join('a-int.fits.part')))
+
+
+def test_complete_part_file(server, tmpdir):
+    # THE SERVER ANSWERS 416 WHEN THE PART FILE ALREADY HOLDS EVERY BYTE
+    data = fits_bytes(3)
+    server.files['/tiles/a-int.fits'] = data
+    with open(str(tmpdir.join('a-int.fits.part')), 'wb') as f:
+        f.write(data)
+
+    counts, failed = downloader(server, tmpdir).download(['http://archive.example/tiles/a-int.fits'])
+    assert counts == {'downloaded': 1}
+    assert read(str(tmpdir.join('a-int.fits'))) == data
+
+
+def test_resume_interrupted_download(server, tmpdir):
+    data = fits_bytes(4)
+    server.files['/tiles/a-int.fits'] = data
+    server.drop.add('/tiles/a-int.fits')
+
+    counts, failed = downloader(server, tmpdir).download(['http://archive.example/tiles/a-int.fits'])
+    assert counts == {'downloaded': 1}
+    assert server.requests == [('/tiles/a-int.fits', None), ('/tiles/a-int.fits', 'bytes=' + str(len(data) // 2) + '-')]
+    assert read(str(tmpdir.join('a-int.fits'))) == data
+
+
+def test_refetch_corrupt_file(server, tmpdir):
+    data = fits_bytes(5)
+    server.files['/tiles/a-int.fits'] = data
+    with open(str(tmpdir.join('a-int.fits')), 'wb') as f:
+        f.write(data[:2880 * 2])
+
+    counts, failed = downloader(server, tmpdir).download(['http://archive.example/tiles/a-int.fits'])
+    assert counts == {'downloaded': 1}
+    assert read(str(tmpdir.join('a-int.fits'))) == data
+
+
+def test_reject_corrupt_download(server, tmpdir):
+    # A FILE THAT IS NOT VALID FITS IS NEVER MOVED INTO PLACE
+    server.files['/tiles/a-int.fits'] = b'x' * 2880
+
+    counts, failed = downloader(server, tmpdir).download(['http://archive.example/tiles/a-int.fits'])
+    assert counts == {'failed': 1}
+    assert os.listdir(str(tmpdir)) == []